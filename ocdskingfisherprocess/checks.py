@@ -1,25 +1,244 @@
+import contextlib
 import datetime
+import json
 import logging
+import multiprocessing
+import resource
 import shutil
 import tempfile
 
+import pkg_resources
 import sqlalchemy as sa
+from jsonschema import Draft4Validator, FormatChecker
 from libcoveocds.api import APIException, ocds_json_output
 from libcoveocds.config import LibCoveOCDSConfig
+from libcoveocds.schema import SchemaOCDS
 from sentry_sdk import capture_exception
 
+# These constants list the values that are written to the database,
+# and should not be changed without changing contents in the database.
+CHECK_LEVEL_FULL = 'full'
+CHECK_LEVEL_SCHEMA = 'schema'
+
+# The number of rows to fetch from the database at a time when looking for data to check.
+CHECK_BATCH_SIZE = 1000
+
+# Building a validator means downloading and dereferencing the schema and any extensions, so it is only done once for
+# each type of package, schema version and list of extensions.
+_schema_validators = {}
+
+_libcoveocds_config = LibCoveOCDSConfig()
+_libcoveocds_config.config['cache_all_requests'] = True
+
+
+def get_checker_version(config):
+    """Returns the version of the checks, which is stored with each result. When it changes, data is checked again.
+    This is the version of libcoveocds, unless set in config - for example, to re-check after a schema change."""
+    if config.checker_version:
+        return config.checker_version
+    return 'libcoveocds-' + pkg_resources.get_distribution('libcoveocds').version
+
+
+class CheckTimeoutException(Exception):
+    pass
+
+
+def get_check_worker(config):
+    """Returns a worker to run checks in, or None if checks are run in the main process. A command that checks many
+    collections or items should get one worker and pass it to each Checks, so that the schemas and extensions that the
+    worker downloads are cached for the whole command."""
+    if config.check_timeout_seconds or config.check_memory_limit_mb:
+        return CheckWorker(_handle_package, config.check_timeout_seconds, config.check_memory_limit_mb)
+    return None
+
+
+class CheckWorker:
+    """Runs checks in a child process, so that a check that takes too long or uses too much memory can be stopped
+    without stopping the whole run. The child process is started when first needed, and is only restarted after a
+    check is stopped, so that it keeps what it has cached.
+    """
+
+    def __init__(self, handle_package, timeout_seconds, memory_limit_mb):
+        self.handle_package = handle_package
+        self.timeout_seconds = timeout_seconds
+        self.memory_limit_mb = memory_limit_mb
+        self._process = None
+        self._connection = None
+
+    def check(self, check_level, package):
+        if not self._process:
+            self._start()
+
+        try:
+            self._connection.send((check_level, package))
+            if not self._connection.poll(self.timeout_seconds or None):
+                self.stop()
+                raise CheckTimeoutException('Check timed out after {} seconds'.format(self.timeout_seconds))
+            status, value = self._connection.recv()
+        except (EOFError, OSError):
+            # The child process died, probably because it ran out of memory.
+            exitcode = self._process.exitcode
+            self.stop()
+            raise CheckTimeoutException('Check worker exited unexpectedly with exit code {}'.format(exitcode))
+
+        if status == 'error':
+            raise value
+        return value
+
+    def stop(self):
+        if self._process:
+            self._connection.close()
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+            self._connection = None
+
+    def _start(self):
+        # fork, so that the child process doesn't need to import everything again.
+        context = multiprocessing.get_context('fork')
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_run_check_worker,
+            args=(self._connection, child_connection, self.handle_package, self.memory_limit_mb),
+            daemon=True,
+        )
+        self._process.start()
+        child_connection.close()
+
+
+def _run_check_worker(parent_connection, connection, handle_package, memory_limit_mb):
+    # Close the parent's end, so that the child process notices when the parent process exits.
+    parent_connection.close()
+
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            check_level, package = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            result = ('output', handle_package(check_level, package))
+        except Exception as err:
+            result = ('error', err)
+
+        try:
+            connection.send(result)
+        except Exception:
+            # The exception can't be pickled.
+            connection.send(('error', Exception(str(result[1]))))
+
+
+def _handle_package(check_level, package):
+    """Checks a package with one release or record, and returns the output in the format of CoVE."""
+    if check_level == CHECK_LEVEL_SCHEMA:
+        return _handle_package_schema_only(package)
+    return _handle_package_full(package)
+
+
+def _handle_package_schema_only(package):
+    # Only JSON Schema validation is run, and the output only has the validation errors, in the same format as
+    # the output of CoVE.
+    validator = _get_schema_validator(package)
+    validation_errors = []
+    for error in validator.iter_errors(package):
+        validation_errors.append({
+            'type': _get_validation_error_type(error),
+            'field': '/'.join(str(item) for item in error.path if not isinstance(item, int)),
+            'description': error.message,
+            'path': '/'.join(str(item) for item in error.path),
+            'value': '' if isinstance(error.instance, (dict, list)) else error.instance,
+        })
+    return {'validation_errors': validation_errors}
+
+
+def _get_validation_error_type(error):
+    if error.validator not in ('format', 'type'):
+        return error.validator
+    # A field that can be null has a list of types, which CoVE joins.
+    if isinstance(error.validator_value, list):
+        return ', '.join(error.validator_value)
+    return error.validator_value
+
+
+def _get_schema_validator(package):
+    package_type = 'record' if 'records' in package else 'release'
+    key = (package_type, package.get('version', '1.0'), json.dumps(package.get('extensions')))
+    if key not in _schema_validators:
+        schema_ocds = SchemaOCDS(release_data=package, lib_cove_ocds_config=_libcoveocds_config)
+        if schema_ocds.invalid_version_data:
+            raise APIException('The schema version in your data is not valid. Accepted values: {}'.format(
+                list(schema_ocds.version_choices.keys())))
+        # This applies the extensions, which the package schemas then use.
+        schema_ocds.get_release_schema_obj()
+        if package_type == 'record':
+            schema = schema_ocds.get_record_pkg_schema_obj(deref=True)
+        else:
+            schema = schema_ocds.get_release_pkg_schema_obj(deref=True)
+        _schema_validators[key] = Draft4Validator(schema, format_checker=FormatChecker())
+    return _schema_validators[key]
+
+
+def _handle_package_full(package):
+    cove_temp_folder = tempfile.mkdtemp(prefix='ocdskingfisher-cove-', dir=tempfile.gettempdir())
+    try:
+        output = ocds_json_output(cove_temp_folder, None, None,
+                                  convert=False,
+                                  lib_cove_ocds_config=_libcoveocds_config,
+                                  file_type='json',
+                                  json_data=package)
+        output.pop('releases_aggregates', None)
+        output.pop('records_aggregates', None)
+        return output
+    finally:
+        shutil.rmtree(cove_temp_folder)
+
 
 class Checks:
 
-    def __init__(self, database, collection, run_until_timestamp=None):
+    def __init__(self, database, collection, run_until_timestamp=None, check_level=None, max_items=None,
+                 use_cursor=True, check_worker=None):
         self.database = database
         self.collection = collection
         self.run_until_timestamp = run_until_timestamp
+        self.max_items = max_items
+        self.items_checked = 0
+        self.use_cursor = use_cursor
+        self.check_level = check_level or collection.check_level or CHECK_LEVEL_FULL
+        self.sampled = collection.check_sample_rate is not None or collection.check_sample_size is not None
+        self.checker_version = get_checker_version(database.config)
         self.logger = logging.getLogger('ocdskingfisher.checks')
-        self.libcoveocds_config = LibCoveOCDSConfig()
-        self.libcoveocds_config.config['cache_all_requests'] = True
+        # A worker that is passed in belongs to the caller, which stops it. Otherwise, this gets its own.
+        if check_worker:
+            self.check_worker = check_worker
+            self._owns_check_worker = False
+        else:
+            self.check_worker = get_check_worker(database.config)
+            self._owns_check_worker = True
 
     def process_all_files(self):
+        # items_checked and max_items are for each call, so that one Checks can be used for a slice at a time.
+        self.items_checked = 0
+        try:
+            self._process_all_files()
+        finally:
+            self._stop_check_worker()
+
+    def process_file_item_id(self, collection_file_item_id):
+        self.items_checked = 0
+        try:
+            self._process_file_item_id(collection_file_item_id)
+        finally:
+            self._stop_check_worker()
+
+    def _stop_check_worker(self):
+        if self.check_worker and self._owns_check_worker:
+            self.check_worker.stop()
+
+    def _process_all_files(self):
 
         self.logger.info('process_all_files called for collection ' + str(self.collection.database_id))
 
@@ -27,37 +246,51 @@ class Checks:
         if self.collection.deleted_at:
             return
 
+        # Data that has never been checked is checked first.
+        self._process_all_files_with_checker_version(None)
+
+        # Early return?
+        if self._should_stop():
+            return
+
+        # Then data that was checked by an older version of the checks is checked again. The old results are kept.
+        self._process_all_files_with_checker_version(self.checker_version)
+
+    def _process_all_files_with_checker_version(self, checker_version):
+
         # Normal Checks
         if self.collection.check_data:
 
-            self._process_releases(self.database.get_releases_to_check(self.collection.database_id))
+            with contextlib.closing(self._get_releases_to_check(checker_version=checker_version)) as releases:
+                self._process_releases(releases, checker_version=checker_version)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
-            self._process_records(self.database.get_records_to_check(self.collection.database_id))
+            with contextlib.closing(self._get_records_to_check(checker_version=checker_version)) as records:
+                self._process_records(records, checker_version=checker_version)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
         # Checks with schema V1.1
         if self.collection.check_older_data_with_schema_version_1_1:
 
-            self._process_releases_with_override_schema_version_1_1(
-                self.database.get_releases_to_check(self.collection.database_id, override_schema_version="1.1")
-            )
+            with contextlib.closing(self._get_releases_to_check(override_schema_version="1.1",
+                                                                checker_version=checker_version)) as releases:
+                self._process_releases_with_override_schema_version_1_1(releases, checker_version=checker_version)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
-            self._process_records_with_override_schema_version_1_1(
-                self.database.get_records_to_check(self.collection.database_id, override_schema_version="1.1")
-            )
+            with contextlib.closing(self._get_records_to_check(override_schema_version="1.1",
+                                                               checker_version=checker_version)) as records:
+                self._process_records_with_override_schema_version_1_1(records, checker_version=checker_version)
 
-    def process_file_item_id(self, collection_file_item_id):
+    def _process_file_item_id(self, collection_file_item_id):
 
         self.logger.info('process_file_item_id called for collection file item id ' + str(collection_file_item_id))
 
@@ -65,6 +298,11 @@ class Checks:
         if self.collection.deleted_at:
             return
 
+        # Is sampled? Which data is in a sample of a given size depends on the whole collection, so leave it to
+        # process_all_files.
+        if self.sampled:
+            return
+
         # Normal Checks
         if self.collection.check_data:
 
@@ -75,7 +313,7 @@ class Checks:
             self._process_releases(releases)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
             s = sa.sql.select([self.database.record_table]) \
@@ -85,7 +323,7 @@ class Checks:
             self._process_records(records)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
         # Checks with schema V1.1
@@ -98,7 +336,7 @@ class Checks:
             self._process_releases_with_override_schema_version_1_1(releases)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
             s = sa.sql.select([self.database.record_table]) \
@@ -108,60 +346,96 @@ class Checks:
             self._process_records_with_override_schema_version_1_1(records)
 
             # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            if self._should_stop():
                 return
 
-    def _process_releases(self, releases):
+    def _should_stop(self):
+        if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+            return True
+        if self.max_items and self.items_checked >= self.max_items:
+            return True
+        return False
+
+    def _get_releases_to_check(self, override_schema_version='', checker_version=None):
+        return self._get_to_check('release', self.database.get_releases_to_check, override_schema_version,
+                                  checker_version)
+
+    def _get_records_to_check(self, override_schema_version='', checker_version=None):
+        return self._get_to_check('record', self.database.get_records_to_check, override_schema_version,
+                                  checker_version)
+
+    def _get_to_check(self, data_type, get_to_check, override_schema_version, checker_version):
+        """Yields the rows to check in order of id. Unless use_cursor is false, this starts after the last row that an
+        earlier run got to, and records how far this run gets when it is closed."""
+        cursor_key = (self.collection.database_id, data_type, override_schema_version, self.check_level,
+                      checker_version or '')
+        start_id = last_id = self.database.get_check_cursor(*cursor_key) if self.use_cursor else 0
+        rows = get_to_check(self.collection.database_id,
+                            override_schema_version=override_schema_version,
+                            check_level=self.check_level,
+                            checker_version=checker_version,
+                            sample_rate=self.collection.check_sample_rate,
+                            sample_size=self.collection.check_sample_size,
+                            after_id=last_id,
+                            batch_size=CHECK_BATCH_SIZE)
+        try:
+            with contextlib.closing(rows):
+                for row in rows:
+                    yield row
+                    # The caller has asked for the next row, so it has finished with this one.
+                    last_id = row['id']
+        finally:
+            if self.use_cursor and last_id > start_id:
+                self.database.set_check_cursor(*cursor_key, last_id)
+
+    def _process_releases(self, releases, checker_version=None):
         for release_row in releases:
+            # Early return? This is before the check rather than after, so the cursor counts the last row checked.
+            if self._should_stop():
+                return
             # Do Normal Check?
-            if not self.database.is_release_check_done(release_row['id']):
+            if not self.database.is_release_check_done(release_row['id'], check_level=self.check_level,
+                                                       checker_version=checker_version):
                 self._check_release_row(release_row)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
 
-    def _process_records(self, records):
+    def _process_records(self, records, checker_version=None):
         for record_row in records:
+            # Early return? This is before the check rather than after, so the cursor counts the last row checked.
+            if self._should_stop():
+                return
             # Do Normal Check?
-            if not self.database.is_record_check_done(record_row['id']):
+            if not self.database.is_record_check_done(record_row['id'], check_level=self.check_level,
+                                                      checker_version=checker_version):
                 self._check_record_row(record_row)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
 
-    def _process_releases_with_override_schema_version_1_1(self, releases):
+    def _process_releases_with_override_schema_version_1_1(self, releases, checker_version=None):
         for release_row in releases:
+            # Early return? This is before the check rather than after, so the cursor counts the last row checked.
+            if self._should_stop():
+                return
             # Do 1.1 check?
             if self._is_schema_version_less_than_1_1(release_row['package_data_id']) \
-                    and not self.database.is_release_check_done(release_row['id'], override_schema_version="1.1"):
+                    and not self.database.is_release_check_done(release_row['id'], override_schema_version="1.1",
+                                                                check_level=self.check_level,
+                                                                checker_version=checker_version):
                 self._check_release_row(release_row, override_schema_version="1.1")
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
 
-    def _process_records_with_override_schema_version_1_1(self, records):
+    def _process_records_with_override_schema_version_1_1(self, records, checker_version=None):
         for record_row in records:
+            # Early return? This is before the check rather than after, so the cursor counts the last row checked.
+            if self._should_stop():
+                return
             # Do 1.1 check?
             if self._is_schema_version_less_than_1_1(record_row['package_data_id']) \
-                    and not self.database.is_record_check_done(record_row['id'], override_schema_version="1.1"):
+                    and not self.database.is_record_check_done(record_row['id'], override_schema_version="1.1",
+                                                               check_level=self.check_level,
+                                                               checker_version=checker_version):
                 self._check_record_row(record_row, override_schema_version="1.1")
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
 
-    def _handle_package(self, package):
-        cove_temp_folder = tempfile.mkdtemp(prefix='ocdskingfisher-cove-', dir=tempfile.gettempdir())
-        try:
-            output = ocds_json_output(cove_temp_folder, None, None,
-                                      convert=False,
-                                      lib_cove_ocds_config=self.libcoveocds_config,
-                                      file_type='json',
-                                      json_data=package)
-            output.pop('releases_aggregates', None)
-            output.pop('records_aggregates', None)
-            return output
-        finally:
-            shutil.rmtree(cove_temp_folder)
+    def _check_package(self, package):
+        if self.check_worker:
+            return self.check_worker.check(self.check_level, package)
+        return _handle_package(self.check_level, package)
 
     def _is_schema_version_less_than_1_1(self, package_data_id):
         # Performance wise, this is a bit dumb. We are basically calling get_package_data twice in a row!
@@ -171,6 +445,7 @@ class Checks:
         return 'version' not in data or data['version'] == "1.0"
 
     def _check_release_row(self, release_row, override_schema_version=''):
+        self.items_checked += 1
         self.logger.debug('check_release_row called for row ' + str(release_row.id) +
                           ' in collection ' + str(self.collection.database_id))
         package = self.database.get_package_data(release_row.package_data_id)
@@ -178,18 +453,18 @@ class Checks:
         if override_schema_version:
             package['version'] = override_schema_version
         try:
-            cove_output = self._handle_package(package)
-            checks = [{
-                'release_id': release_row.id,
-                'cove_output': cove_output,
-                'override_schema_version': override_schema_version
-            }]
-            with self.database.get_engine().begin() as connection:
-                connection.execute(self.database.release_check_table.insert(), checks)
+            cove_output = self._check_package(package)
+            self.database.store_release_check(self.collection.database_id, release_row.id, override_schema_version,
+                                              cove_output, check_level=self.check_level, sampled=self.sampled,
+                                              checker_version=self.checker_version)
         except APIException as err:
             # This is a specific exception throw by the library.
             # We save it to the database
             self._store_release_row_error(release_row, override_schema_version, err)
+        except CheckTimeoutException as err:
+            # This data is too big or complicated to check within the limits.
+            # We save it to the database, and move on
+            self._store_release_row_error(release_row, override_schema_version, err)
         except Exception as err:
             # This is any old exception
             # We save it to the database
@@ -198,6 +473,7 @@ class Checks:
             capture_exception(err)
 
     def _check_record_row(self, record_row, override_schema_version=''):
+        self.items_checked += 1
         self.logger.debug('check_record_row called for row ' + str(record_row.id) +
                           ' in collection ' + str(self.collection.database_id))
         package = self.database.get_package_data(record_row.package_data_id)
@@ -205,18 +481,18 @@ class Checks:
         if override_schema_version:
             package['version'] = override_schema_version
         try:
-            cove_output = self._handle_package(package)
-            checks = [{
-                'record_id': record_row.id,
-                'cove_output': cove_output,
-                'override_schema_version': override_schema_version
-            }]
-            with self.database.get_engine().begin() as connection:
-                connection.execute(self.database.record_check_table.insert(), checks)
+            cove_output = self._check_package(package)
+            self.database.store_record_check(self.collection.database_id, record_row.id, override_schema_version,
+                                             cove_output, check_level=self.check_level, sampled=self.sampled,
+                                             checker_version=self.checker_version)
         except APIException as err:
             # This is a specific exception throw by the library.
             # We save it to the database
             self._store_record_row_error(record_row, override_schema_version, err)
+        except CheckTimeoutException as err:
+            # This data is too big or complicated to check within the limits.
+            # We save it to the database, and move on
+            self._store_record_row_error(record_row, override_schema_version, err)
         except Exception as err:
             # This is any old exception
             # We save it to the database
@@ -228,7 +504,10 @@ class Checks:
         checks = [{
             'release_id': release_row.id,
             'error': str(err),
-            'override_schema_version': override_schema_version
+            'override_schema_version': override_schema_version,
+            'check_level': self.check_level,
+            'checker_version': self.checker_version,
+            'sampled': self.sampled,
         }]
         with self.database.get_engine().begin() as connection:
             connection.execute(self.database.release_check_error_table.insert(), checks)
@@ -237,7 +516,10 @@ class Checks:
         checks = [{
             'record_id': record_row.id,
             'error': str(err),
-            'override_schema_version': override_schema_version
+            'override_schema_version': override_schema_version,
+            'check_level': self.check_level,
+            'checker_version': self.checker_version,
+            'sampled': self.sampled,
         }]
         with self.database.get_engine().begin() as connection:
             connection.execute(self.database.record_check_error_table.insert(), checks)
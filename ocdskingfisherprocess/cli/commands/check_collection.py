@@ -1,6 +1,6 @@
 import ocdskingfisherprocess.cli.commands.base
 import ocdskingfisherprocess.database
-from ocdskingfisherprocess.checks import Checks
+from ocdskingfisherprocess.checks import CHECK_LEVEL_FULL, CHECK_LEVEL_SCHEMA, Checks
 
 
 class CheckCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
@@ -8,10 +8,13 @@ class CheckCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
 
     def configure_subparser(self, subparser):
         self.configure_subparser_for_selecting_existing_collection(subparser)
+        subparser.add_argument("--level", choices=[CHECK_LEVEL_FULL, CHECK_LEVEL_SCHEMA],
+                               help="Check level. Defaults to the collection's check level.")
 
     def run_command(self, args):
 
         self.run_command_for_selecting_existing_collection(args)
 
-        checks = Checks(self.database, self.collection)
+        # This isn't timeboxed, so look at all the data rather than continuing from the last check-collections run.
+        checks = Checks(self.database, self.collection, check_level=args.level, use_cursor=False)
         checks.process_all_files()
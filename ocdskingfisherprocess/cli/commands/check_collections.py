@@ -5,7 +5,7 @@ from threading import Timer
 
 import ocdskingfisherprocess.cli.commands.base
 import ocdskingfisherprocess.database
-from ocdskingfisherprocess.checks import Checks
+from ocdskingfisherprocess.checks import Checks, get_check_worker, get_checker_version
 
 
 class CheckCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
@@ -14,8 +14,15 @@ class CheckCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLIComm
     def configure_subparser(self, subparser):
         subparser.add_argument("--runforseconds",
                                help="Run for this many seconds only.")
+        subparser.add_argument("--itemsperround", type=int, default=1000,
+                               help="Check this many releases and records in each collection in turn, "
+                                    "multiplied by the priority of the collection's source. Defaults to 1000.")
 
     def run_command(self, args):
+        if args.itemsperround < 1:
+            print("--itemsperround must be at least 1")
+            return
+
         logger = logging.getLogger('ocdskingfisher.cli.check-collections')
         logger.info("Starting command")
         run_until_timestamp = None
@@ -29,15 +36,38 @@ class CheckCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLIComm
 
             Timer(run_for_seconds + 60, exitfunc).start()
 
-        for collection in self.database.get_all_collections():
-            if not args.quiet:
-                print("Collection " + str(collection.database_id))
-            logger.info("Starting to check collection " + str(collection.database_id))
-            checks = Checks(self.database, collection, run_until_timestamp=run_until_timestamp)
-            checks.process_all_files()
-            # Early return?
-            if run_until_timestamp and run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                break
+        collections = self.database.get_collections_with_pending_work(
+            ocdskingfisherprocess.database.PENDING_WORK_CHECK,
+            checker_version=get_checker_version(self.config))
+
+        # One worker is used for every collection, so that it keeps what it has cached.
+        check_worker = get_check_worker(self.config)
+
+        # Each collection is checked in turn, a slice at a time, so that a collection with a lot of data to check
+        # doesn't hold up the others. A collection is dropped from the rounds when it has nothing left to check.
+        checks_by_collection = {
+            collection.database_id: Checks(
+                self.database, collection, run_until_timestamp=run_until_timestamp,
+                max_items=args.itemsperround * self.config.get_check_priority(collection.source_id),
+                check_worker=check_worker)
+            for collection in collections
+        }
+        while collections:
+            for collection in list(collections):
+                if not args.quiet:
+                    print("Collection " + str(collection.database_id))
+                logger.info("Starting to check collection " + str(collection.database_id))
+                checks = checks_by_collection[collection.database_id]
+                checks.process_all_files()
+                if checks.items_checked < checks.max_items:
+                    collections.remove(collection)
+                # Early return?
+                if run_until_timestamp and run_until_timestamp < datetime.datetime.utcnow().timestamp():
+                    collections = []
+                    break
+
+        if check_worker:
+            check_worker.stop()
 
         # If the code above took less than 60 seconds the process will stay open, waiting for the Timer to execute.
         # So just kill it to make sure.
@@ -1,6 +1,7 @@
 import logging
 
 import ocdskingfisherprocess.cli.commands.base
+import ocdskingfisherprocess.database
 
 
 class DeleteCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
@@ -9,12 +10,12 @@ class DeleteCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICom
     def run_command(self, args):
         logger = logging.getLogger('ocdskingfisher.cli.delete-collections')
         logger.info("Starting command")
-        for collection in self.database.get_all_collections():
-            if collection.deleted_at is not None:
-                if not args.quiet:
-                    print("Collection " + str(collection.database_id))
-                logger.info("Starting to delete collection " + str(collection.database_id))
-                self.database.delete_collection(collection.database_id)
+        for collection in self.database.get_collections_with_pending_work(
+                ocdskingfisherprocess.database.PENDING_WORK_DELETE):
+            if not args.quiet:
+                print("Collection " + str(collection.database_id))
+            logger.info("Starting to delete collection " + str(collection.database_id))
+            self.database.delete_collection(collection.database_id)
         if not args.quiet:
             print("Orphan Data")
         logger.info("Starting to delete orphan data")
@@ -55,6 +55,8 @@ class ProcessRedisQueueCLICommand(ocdskingfisherprocess.cli.commands.base.CLICom
             if run_until_timestamp and run_until_timestamp < datetime.datetime.utcnow().timestamp():
                 run = False
 
+        process_que_message.close()
+
         # If the code above took less than 60 seconds the process will stay open, waiting for the Timer to execute.
         # So just kill it to make sure.
         os._exit(0)
@@ -66,15 +66,15 @@ class TransformCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLI
                 executor.submit(
                     self.run_collection, collection, run_until_timestamp, args
                 )
-                for collection in self.database.get_all_collections()
+                for collection in self.database.get_collections_with_pending_work(
+                    ocdskingfisherprocess.database.PENDING_WORK_TRANSFORM)
                 # Lets keep number of possible threads low!
-                # Only if is a transform and works needs doing
+                # Only transforms that haven't finished are returned.
                 # [ There are more things than just "not collection.store_end_at" to check
                 #    to work out if "works needs doing" but
                 #    A) We don't want to duplicate lots of them here
                 #    B) They vary by type and are complex
                 #    C) "not collection.store_end_at" should catch a lot of collections, that will do us for now ]
-                if collection.transform_type and not collection.store_end_at
             ]
 
             for future in concurrent.futures.as_completed(futures):
@@ -11,9 +11,9 @@ class UpdateCollectionCachesCLICommand(ocdskingfisherprocess.cli.commands.base.C
         logger = logging.getLogger('ocdskingfisher.cli.update-collection-caches')
         logger.info("Starting command")
 
-        for collection in self.database.get_all_collections():
-            if collection.store_end_at:
-                if not args.quiet:
-                    print("Collection " + str(collection.database_id))
-                logger.info("Starting to update caches for collection " + str(collection.database_id))
-                self.database.update_collection_cached_columns(collection.database_id)
+        for collection in self.database.get_collections_with_pending_work(
+                ocdskingfisherprocess.database.PENDING_WORK_UPDATE_CACHES):
+            if not args.quiet:
+                print("Collection " + str(collection.database_id))
+            logger.info("Starting to update caches for collection " + str(collection.database_id))
+            self.database.update_collection_cached_columns(collection.database_id)
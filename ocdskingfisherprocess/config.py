@@ -21,10 +21,20 @@ class Config:
         self._database_name = ''
         self._database_password = ''
         self.run_standard_pipeline = False
+        self.standard_pipeline_upgrade_on_write = False
         self.redis_host = ''
         self.redis_port = 6379
         self.redis_database = 0
         self.sentry_dsn = ''
+        self.check_timeout_seconds = 300
+        self.check_memory_limit_mb = 0
+        self.check_level = 'full'
+        self.checker_version = ''
+        self.check_priorities = {}
+        self.compile_releases_workers = 1
+        self.compile_releases_schema = ''
+        self.compile_releases_while_storing = False
+        self.upgrade_1_0_to_1_1_workers = 1
 
     def load_user_config(self):
         # First, try and load any config in the ini files
@@ -100,6 +110,8 @@ class Config:
 
         self.run_standard_pipeline = \
             config.getboolean('STANDARD_PIPELINE', 'RUN', fallback=False)
+        self.standard_pipeline_upgrade_on_write = \
+            config.getboolean('STANDARD_PIPELINE', 'UPGRADE_ON_WRITE', fallback=False)
 
         self.redis_host = config.get('REDIS', 'HOST', fallback='')
         self.redis_port = config.get('REDIS', 'PORT', fallback=6379)
@@ -107,5 +119,26 @@ class Config:
 
         self.sentry_dsn = config.get('SENTRY', 'DSN', fallback='')
 
+        self.check_timeout_seconds = config.getint('CHECKS', 'TIMEOUT_SECONDS', fallback=300)
+        self.check_memory_limit_mb = config.getint('CHECKS', 'MEMORY_LIMIT_MB', fallback=0)
+        self.check_level = config.get('CHECKS', 'LEVEL', fallback='full')
+        self.checker_version = config.get('CHECKS', 'VERSION', fallback='')
+        if config.has_section('CHECK_PRIORITY'):
+            self.check_priorities = {key: int(value) for key, value in config.items('CHECK_PRIORITY')}
+            for key, value in self.check_priorities.items():
+                # A collection is checked until a round checks fewer items than its priority allows.
+                if value < 1:
+                    raise ValueError('The check priority of {} must be at least 1, not {}'.format(key, value))
+
+        self.compile_releases_workers = config.getint('TRANSFORM', 'COMPILE_RELEASES_WORKERS', fallback=1)
+        self.compile_releases_schema = config.get('TRANSFORM', 'COMPILE_RELEASES_SCHEMA', fallback='')
+        self.compile_releases_while_storing = \
+            config.getboolean('TRANSFORM', 'COMPILE_RELEASES_WHILE_STORING', fallback=False)
+        self.upgrade_1_0_to_1_1_workers = config.getint('TRANSFORM', 'UPGRADE_1_0_TO_1_1_WORKERS', fallback=1)
+
+    def get_check_priority(self, source_id):
+        # configparser lower cases keys.
+        return self.check_priorities.get(source_id.lower(), 1)
+
     def is_redis_available(self):
         return self.redis_host and self.redis_port
@@ -7,12 +7,19 @@ from functools import partial
 
 import alembic.config
 import sqlalchemy as sa
-from sqlalchemy.dialects.postgresql import JSONB
+from ocdskit.upgrade import upgrade_10_11
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
 
 from ocdskingfisherprocess.models import CollectionModel, CollectionNoteModel, FileItemModel, FileModel
 from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
 from ocdskingfisherprocess.util import get_hash_md5_for_data
 
+# These constants list the kinds of work that get_collections_with_pending_work can look for.
+PENDING_WORK_CHECK = 'check'
+PENDING_WORK_TRANSFORM = 'transform'
+PENDING_WORK_UPDATE_CACHES = 'update-caches'
+PENDING_WORK_DELETE = 'delete'
+
 
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -39,6 +46,9 @@ class DataBase:
                                          sa.Column('check_data', sa.Boolean, nullable=False, default=False),
                                          sa.Column('check_older_data_with_schema_version_1_1', sa.Boolean,
                                                    nullable=False, default=False),
+                                         sa.Column('check_level', sa.Text, nullable=False, server_default='full'),
+                                         sa.Column('check_sample_rate', sa.Float, nullable=True),
+                                         sa.Column('check_sample_size', sa.Integer, nullable=True),
                                          sa.Column('transform_from_collection_id', sa.Integer,
                                                    sa.ForeignKey("collection.id"), nullable=True),
                                          sa.Column('transform_type', sa.Text, nullable=False),
@@ -64,6 +74,9 @@ class DataBase:
                                               sa.Column('stored_at', sa.DateTime(timezone=False), nullable=False),
                                               sa.Index('collection_note_collection_id_idx', 'collection_id'),
                                               )
+        # Notes can be long, so they are compared by hash.
+        sa.Index('unique_collection_note_identifiers', self.collection_note_table.c.collection_id,
+                 sa.func.md5(self.collection_note_table.c.note), unique=True)
 
         self.collection_file_table = sa.Table('collection_file', self.metadata,
                                               sa.Column('id', sa.Integer, primary_key=True),
@@ -132,6 +145,7 @@ class DataBase:
                                       sa.Index('release_collection_id_idx', 'collection_id'),
                                       sa.Index('release_collection_file_item_id_idx', 'collection_file_item_id'),
                                       sa.Index('release_ocid_idx', 'ocid'),
+                                      sa.Index('release_collection_id_ocid_idx', 'collection_id', 'ocid'),
                                       sa.Index('release_package_data_id_idx', 'package_data_id'),
                                       )
 
@@ -161,6 +175,7 @@ class DataBase:
                                      sa.Index('record_collection_id_idx', 'collection_id'),
                                      sa.Index('record_collection_file_item_id_idx', 'collection_file_item_id'),
                                      sa.Index('record_ocid_idx', 'ocid'),
+                                     sa.Index('record_collection_id_ocid_idx', 'collection_id', 'ocid'),
                                      sa.Index('record_package_data_id_idx', 'package_data_id'),
                                      )
 
@@ -189,30 +204,160 @@ class DataBase:
                                                    'collection_file_item_id'
                                                ),
                                                sa.Index('compiled_release_ocid_idx', 'ocid'),
+                                               sa.Index('compiled_release_collection_id_ocid_idx', 'collection_id',
+                                                        'ocid'),
                                                )
 
+        self.check_output_table = sa.Table('check_output', self.metadata,
+                                           sa.Column('id', sa.Integer, primary_key=True),
+                                           sa.Column('hash_md5', sa.Text, nullable=False),
+                                           sa.Column('data', JSONB, nullable=False),
+                                           sa.UniqueConstraint('hash_md5', name='unique_check_output_hash_md5'),
+                                           )
+
+        self.release_check_result_table = sa.Table('release_check_result', self.metadata,
+                                                   sa.Column('id', sa.Integer, primary_key=True),
+                                                   sa.Column('release_id', sa.Integer,
+                                                             sa.ForeignKey("release.id",
+                                                                           name="fk_release_check_release_id"),
+                                                             nullable=False),
+                                                   sa.Column('override_schema_version', sa.Text, nullable=False),
+                                                   sa.Column('check_level', sa.Text, nullable=False,
+                                                             server_default='full'),
+                                                   sa.Column('sampled', sa.Boolean, nullable=False,
+                                                             server_default=sa.false()),
+                                                   sa.Column('checker_version', sa.Text, nullable=False,
+                                                             server_default=''),
+                                                   sa.Column('check_output_id', sa.Integer,
+                                                             sa.ForeignKey(
+                                                                 "check_output.id",
+                                                                 name="fk_release_check_result_check_output_id"),
+                                                             nullable=False),
+                                                   sa.UniqueConstraint(
+                                                       'release_id', 'override_schema_version', 'check_level',
+                                                       'checker_version',
+                                                       name='unique_release_check_release_id_and_more'),
+                                                   sa.Index('release_check_release_id_idx', 'release_id'),
+                                                   sa.Index('release_check_result_check_output_id_idx',
+                                                            'check_output_id'),
+                                                   )
+
+        self.record_check_result_table = sa.Table('record_check_result', self.metadata,
+                                                  sa.Column('id', sa.Integer, primary_key=True),
+                                                  sa.Column('record_id', sa.Integer,
+                                                            sa.ForeignKey("record.id",
+                                                                          name="fk_record_check_record_id"),
+                                                            nullable=False),
+                                                  sa.Column('override_schema_version', sa.Text, nullable=False),
+                                                  sa.Column('check_level', sa.Text, nullable=False,
+                                                            server_default='full'),
+                                                  sa.Column('sampled', sa.Boolean, nullable=False,
+                                                            server_default=sa.false()),
+                                                  sa.Column('checker_version', sa.Text, nullable=False,
+                                                            server_default=''),
+                                                  sa.Column('check_output_id', sa.Integer,
+                                                            sa.ForeignKey(
+                                                                "check_output.id",
+                                                                name="fk_record_check_result_check_output_id"),
+                                                            nullable=False),
+                                                  sa.UniqueConstraint(
+                                                      'record_id', 'override_schema_version', 'check_level',
+                                                      'checker_version',
+                                                      name='unique_record_check_record_id_and_more'),
+                                                  sa.Index('record_check_record_id_idx', 'record_id'),
+                                                  sa.Index('record_check_result_check_output_id_idx',
+                                                           'check_output_id'),
+                                                  )
+
+        self.release_check_validation_error_table = sa.Table(
+            'release_check_validation_error',
+            self.metadata,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('release_check_id', sa.Integer,
+                      sa.ForeignKey("release_check_result.id",
+                                    name="fk_release_check_validation_error_release_check_id"),
+                      nullable=False),
+            sa.Column('type', sa.Text, nullable=True),
+            sa.Column('field', sa.Text, nullable=True),
+            sa.Column('description', sa.Text, nullable=True),
+            sa.Column('path', sa.Text, nullable=True),
+            sa.Column('value', JSONB, nullable=True),
+            sa.Index('release_check_validation_error_release_check_id_idx', 'release_check_id'),
+        )
+
+        self.record_check_validation_error_table = sa.Table(
+            'record_check_validation_error',
+            self.metadata,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('record_check_id', sa.Integer,
+                      sa.ForeignKey("record_check_result.id",
+                                    name="fk_record_check_validation_error_record_check_id"),
+                      nullable=False),
+            sa.Column('type', sa.Text, nullable=True),
+            sa.Column('field', sa.Text, nullable=True),
+            sa.Column('description', sa.Text, nullable=True),
+            sa.Column('path', sa.Text, nullable=True),
+            sa.Column('value', JSONB, nullable=True),
+            sa.Index('record_check_validation_error_record_check_id_idx', 'record_check_id'),
+        )
+
+        self.collection_check_summary_table = sa.Table(
+            'collection_check_summary',
+            self.metadata,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_collection_check_summary_collection_id"),
+                      nullable=False),
+            sa.Column('data_type', sa.Text, nullable=False),
+            sa.Column('override_schema_version', sa.Text, nullable=False),
+            sa.Column('check_level', sa.Text, nullable=False, server_default='full'),
+            sa.Column('checker_version', sa.Text, nullable=False, server_default=''),
+            sa.Column('type', sa.Text, nullable=False),
+            sa.Column('field', sa.Text, nullable=False),
+            sa.Column('count', sa.Integer, nullable=False),
+            sa.Column('error_count', sa.Integer, nullable=False),
+            sa.Column('sample_ids', ARRAY(sa.Integer), nullable=False),
+            sa.UniqueConstraint('collection_id', 'data_type', 'override_schema_version', 'check_level',
+                                'checker_version', 'type', 'field',
+                                name='unique_collection_check_summary_identifiers'),
+        )
+
+        self.collection_check_cursor_table = sa.Table(
+            'collection_check_cursor',
+            self.metadata,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_collection_check_cursor_collection_id"),
+                      nullable=False),
+            sa.Column('data_type', sa.Text, nullable=False),
+            sa.Column('override_schema_version', sa.Text, nullable=False),
+            sa.Column('check_level', sa.Text, nullable=False),
+            sa.Column('checker_version', sa.Text, nullable=False),
+            sa.Column('last_id', sa.Integer, nullable=False),
+            sa.UniqueConstraint('collection_id', 'data_type', 'override_schema_version', 'check_level',
+                                'checker_version', name='unique_collection_check_cursor_identifiers'),
+        )
+
+        # release_check and record_check are views, that put the output of CoVE back together from the tables above.
+        # They are for reading only; write to the tables above instead.
         self.release_check_table = sa.Table('release_check', self.metadata,
                                             sa.Column('id', sa.Integer, primary_key=True),
-                                            sa.Column('release_id', sa.Integer,
-                                                      sa.ForeignKey("release.id", name="fk_release_check_release_id"),
-                                                      nullable=False),
-                                            sa.Column('override_schema_version', sa.Text, nullable=False),
-                                            sa.Column('cove_output', JSONB, nullable=False),
-                                            sa.UniqueConstraint('release_id', 'override_schema_version',
-                                                                name='unique_release_check_release_id_and_more'),
-                                            sa.Index('release_check_release_id_idx', 'release_id'),
+                                            sa.Column('release_id', sa.Integer),
+                                            sa.Column('override_schema_version', sa.Text),
+                                            sa.Column('cove_output', JSONB),
+                                            sa.Column('check_level', sa.Text),
+                                            sa.Column('sampled', sa.Boolean),
+                                            sa.Column('checker_version', sa.Text),
                                             )
 
         self.record_check_table = sa.Table('record_check', self.metadata,
                                            sa.Column('id', sa.Integer, primary_key=True),
-                                           sa.Column('record_id', sa.Integer,
-                                                     sa.ForeignKey("record.id", name="fk_record_check_record_id"),
-                                                     nullable=False),
-                                           sa.Column('override_schema_version', sa.Text, nullable=False),
-                                           sa.Column('cove_output', JSONB, nullable=False),
-                                           sa.UniqueConstraint('record_id', 'override_schema_version',
-                                                               name='unique_record_check_record_id_and_more'),
-                                           sa.Index('record_check_record_id_idx', 'record_id'),
+                                           sa.Column('record_id', sa.Integer),
+                                           sa.Column('override_schema_version', sa.Text),
+                                           sa.Column('cove_output', JSONB),
+                                           sa.Column('check_level', sa.Text),
+                                           sa.Column('sampled', sa.Boolean),
+                                           sa.Column('checker_version', sa.Text),
                                            )
 
         self.release_check_error_table = sa.Table('release_check_error', self.metadata,
@@ -225,10 +370,18 @@ class DataBase:
                                                       nullable=False
                                                   ),
                                                   sa.Column('override_schema_version', sa.Text, nullable=False),
+                                                  sa.Column('check_level', sa.Text, nullable=False,
+                                                            server_default='full'),
+                                                  sa.Column('checker_version', sa.Text, nullable=False,
+                                                            server_default=''),
                                                   sa.Column('error', sa.Text, nullable=False),
+                                                  sa.Column('sampled', sa.Boolean, nullable=False,
+                                                            server_default=sa.false()),
                                                   sa.UniqueConstraint(
                                                       'release_id',
                                                       'override_schema_version',
+                                                      'check_level',
+                                                      'checker_version',
                                                       name='unique_release_check_error_release_id_and_more'),
                                                   sa.Index('release_check_error_release_id_idx', 'release_id'),
                                                   )
@@ -243,14 +396,62 @@ class DataBase:
                                                      nullable=False
                                                  ),
                                                  sa.Column('override_schema_version', sa.Text, nullable=False),
+                                                 sa.Column('check_level', sa.Text, nullable=False,
+                                                           server_default='full'),
+                                                 sa.Column('checker_version', sa.Text, nullable=False,
+                                                           server_default=''),
                                                  sa.Column('error', sa.Text, nullable=False),
+                                                 sa.Column('sampled', sa.Boolean, nullable=False,
+                                                           server_default=sa.false()),
                                                  sa.UniqueConstraint(
                                                      'record_id',
                                                      'override_schema_version',
+                                                     'check_level',
+                                                     'checker_version',
                                                      name='unique_record_check_error_record_id_and_more'),
                                                  sa.Index('record_check_error_record_id_idx', 'record_id'),
                                                  )
 
+        self.compiled_release_memo_table = sa.Table(
+            'compiled_release_memo',
+            self.metadata,
+            sa.Column('hash_md5', sa.Text, nullable=False, primary_key=True),
+            sa.Column('data_id', sa.Integer, sa.ForeignKey("data.id", name="fk_compiled_release_memo_data_id"),
+                      nullable=False),
+            sa.Index('compiled_release_memo_data_id_idx', 'data_id'),
+        )
+
+        self.transform_compile_releases_watermark_table = sa.Table(
+            'transform_compile_releases_watermark',
+            self.metadata,
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_transform_compile_releases_watermark_collection_id"),
+                      nullable=False, primary_key=True),
+            sa.Column('release_id', sa.Integer, nullable=False),
+            sa.Column('record_id', sa.Integer, nullable=False),
+            sa.Column('next_release_id', sa.Integer, nullable=True),
+            sa.Column('next_record_id', sa.Integer, nullable=True),
+            sa.Column('source_store_ended', sa.Boolean, nullable=False, server_default=sa.false()),
+        )
+
+        self.transform_compile_releases_queue_table = sa.Table(
+            'transform_compile_releases_queue',
+            self.metadata,
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_transform_compile_releases_queue_collection_id"),
+                      nullable=False, primary_key=True),
+            sa.Column('ocid', sa.Text, nullable=False, primary_key=True),
+        )
+
+        self.transform_upgrade_1_0_to_1_1_watermark_table = sa.Table(
+            'transform_upgrade_1_0_to_1_1_watermark',
+            self.metadata,
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_transform_upgrade_1_0_to_1_1_watermark_collection_id"),
+                      nullable=False, primary_key=True),
+            sa.Column('collection_file_item_id', sa.Integer, nullable=False),
+        )
+
         self.transform_upgrade_1_0_to_1_1_status_release_table = sa.Table(
             'transform_upgrade_1_0_to_1_1_status_release',
             self.metadata,
@@ -298,7 +499,19 @@ class DataBase:
     def delete_tables(self):
         engine = self.get_engine()
         engine.execute("drop table if exists transform_upgrade_1_0_to_1_1_status_record cascade")
+        engine.execute("drop table if exists compiled_release_memo cascade")
+        engine.execute("drop table if exists transform_compile_releases_queue cascade")
+        engine.execute("drop table if exists transform_compile_releases_watermark cascade")
+        engine.execute("drop table if exists transform_upgrade_1_0_to_1_1_watermark cascade")
         engine.execute("drop table if exists transform_upgrade_1_0_to_1_1_status_release cascade")
+        engine.execute("drop table if exists collection_check_cursor cascade")
+        engine.execute("drop table if exists collection_check_summary cascade")
+        engine.execute("drop table if exists record_check_validation_error cascade")
+        engine.execute("drop table if exists release_check_validation_error cascade")
+        # Dropping these also drops the record_check and release_check views
+        engine.execute("drop table if exists record_check_result cascade")
+        engine.execute("drop table if exists release_check_result cascade")
+        engine.execute("drop table if exists check_output cascade")
         engine.execute("drop table if exists record_check cascade")
         engine.execute("drop table if exists record_check_error cascade")
         engine.execute("drop table if exists release_check cascade")
@@ -365,6 +578,7 @@ class DataBase:
                 'store_start_at': datetime.datetime.utcnow(),
                 'check_data': False,
                 'check_older_data_with_schema_version_1_1': False,
+                'check_level': self.config.check_level,
             })
             collection_id = value.inserted_primary_key[0]
 
@@ -374,42 +588,14 @@ class DataBase:
     def get_all_collections(self):
         with self.get_engine().begin() as connection:
             s = sa.sql.select([self.collection_table]).order_by(self.collection_table.c.id.asc())
-            return [
-                CollectionModel(
-                    database_id=collection['id'],
-                    source_id=collection['source_id'],
-                    data_version=collection['data_version'],
-                    sample=collection['sample'],
-                    transform_type=collection['transform_type'],
-                    transform_from_collection_id=collection['transform_from_collection_id'],
-                    check_data=collection['check_data'],
-                    check_older_data_with_schema_version_1_1=collection['check_older_data_with_schema_version_1_1'],
-                    store_start_at=collection['store_start_at'],
-                    store_end_at=collection['store_end_at'],
-                    deleted_at=collection['deleted_at'],
-                ) for collection in connection.execute(s)
-            ]
+            return [self._get_collection_model(collection) for collection in connection.execute(s)]
 
     def get_collections_that_transform_this_collection(self, collection_id):
         with self.get_engine().begin() as connection:
             s = sa.sql.select([self.collection_table]) \
                 .where(self.collection_table.c.transform_from_collection_id == collection_id)
 
-            return [
-                CollectionModel(
-                    database_id=collection['id'],
-                    source_id=collection['source_id'],
-                    data_version=collection['data_version'],
-                    sample=collection['sample'],
-                    transform_type=collection['transform_type'],
-                    transform_from_collection_id=collection['transform_from_collection_id'],
-                    check_data=collection['check_data'],
-                    check_older_data_with_schema_version_1_1=collection['check_older_data_with_schema_version_1_1'],
-                    store_start_at=collection['store_start_at'],
-                    store_end_at=collection['store_end_at'],
-                    deleted_at=collection['deleted_at'],
-                ) for collection in connection.execute(s)
-            ]
+            return [self._get_collection_model(collection) for collection in connection.execute(s)]
 
     def get_collection(self, collection_id):
         with self.get_engine().begin() as connection:
@@ -418,19 +604,107 @@ class DataBase:
             result = connection.execute(s)
             collection = result.fetchone()
             if collection:
-                return CollectionModel(
-                    database_id=collection['id'],
-                    source_id=collection['source_id'],
-                    data_version=collection['data_version'],
-                    sample=collection['sample'],
-                    transform_type=collection['transform_type'],
-                    transform_from_collection_id=collection['transform_from_collection_id'],
-                    check_data=collection['check_data'],
-                    check_older_data_with_schema_version_1_1=collection['check_older_data_with_schema_version_1_1'],
-                    store_start_at=collection['store_start_at'],
-                    store_end_at=collection['store_end_at'],
-                    deleted_at=collection['deleted_at'],
-                )
+                return self._get_collection_model(collection)
+
+    def get_collections_with_pending_work(self, work, checker_version=None):
+        """Returns the collections that have work of the given kind to do. The database only looks until it finds
+        some work in each collection, so this is much faster than looking at every collection in turn."""
+        sql, data = self._get_pending_work_query(work, checker_version)
+        with self.get_engine().begin() as connection:
+            result = connection.execute(sa.sql.text(sql), data)
+            return [self._get_collection_model(collection) for collection in result]
+
+    def _get_pending_work_query(self, work, checker_version=None):
+        data = {}
+        tables = "collection"
+        if work == PENDING_WORK_CHECK:
+            # Each collection's sample rates are worked out once, like in Checks, rather than for each row looked at.
+            tables += """, LATERAL (
+                SELECT {} AS release_rate, {} AS record_rate
+            ) AS check_sample
+            """.format(_get_sample_rate_expression('release'), _get_sample_rate_expression('record'))
+            conditions = []
+            for flag, override_schema_version in (('check_data', ''),
+                                                  ('check_older_data_with_schema_version_1_1', '1.1')):
+                for obj_type in ('release', 'record'):
+                    # These match the two passes made by Checks: data that has never been checked, then data that
+                    # was checked by another version of the checks.
+                    conditions.append(self._get_pending_check_condition(obj_type, flag, override_schema_version,
+                                                                        None))
+                    if checker_version:
+                        conditions.append(self._get_pending_check_condition(obj_type, flag, override_schema_version,
+                                                                            checker_version))
+            where = "collection.deleted_at IS NULL AND ({})".format(" OR ".join(conditions))
+            if checker_version:
+                data['checker_version'] = checker_version
+        elif work == PENDING_WORK_TRANSFORM:
+            where = "collection.deleted_at IS NULL AND collection.transform_type <> ''" \
+                    " AND collection.store_end_at IS NULL"
+        elif work == PENDING_WORK_UPDATE_CACHES:
+            # The data in a collection doesn't change after the store has ended, so the caches only need to be
+            # calculated once.
+            where = "collection.deleted_at IS NULL AND collection.store_end_at IS NOT NULL" \
+                    " AND (collection.cached_releases_count IS NULL OR collection.cached_records_count IS NULL" \
+                    " OR collection.cached_compiled_releases_count IS NULL)"
+        elif work == PENDING_WORK_DELETE:
+            where = "collection.deleted_at IS NOT NULL"
+        else:
+            raise Exception('Unknown kind of work: ' + work)
+
+        return "SELECT collection.* FROM " + tables + " WHERE " + where + " ORDER BY collection.id", data
+
+    def _get_pending_check_condition(self, obj_type, flag, override_schema_version, checker_version):
+        checked = "release_id = release.id AND override_schema_version = '{}'" \
+                  " AND check_level = collection.check_level".format(override_schema_version)
+        if checker_version:
+            checked += " AND checker_version = :checker_version"
+        sql = """
+            (collection.{flag} AND EXISTS (
+                SELECT FROM release
+        """.format(flag=flag)
+        if override_schema_version:
+            sql += """
+                LEFT JOIN package_data ON package_data.id = release.package_data_id
+                WHERE coalesce(package_data.data ->> 'version', '1.0') <> '{}' AND
+            """.format(override_schema_version)
+        else:
+            sql += """
+                WHERE
+            """
+        # Only data after the check cursor, and in the sample if there is one, is looked at, like in Checks.
+        sql += """
+                    release.collection_id = collection.id
+                    AND release.id > coalesce((
+                        SELECT last_id FROM collection_check_cursor
+                        WHERE collection_id = collection.id AND data_type = 'release'
+                            AND override_schema_version = '{1}' AND check_level = collection.check_level
+                            AND checker_version = {2}
+                    ), 0)
+                    AND NOT EXISTS (SELECT FROM release_check_result WHERE {0})
+                    AND NOT EXISTS (SELECT FROM release_check_error WHERE {0})
+                    AND (check_sample.release_rate IS NULL OR {3})
+            ))
+        """.format(checked, override_schema_version, ':checker_version' if checker_version else "''",
+                   _get_sample_condition('check_sample.release_rate'))
+        return sql.replace('release', obj_type)
+
+    def _get_collection_model(self, collection):
+        return CollectionModel(
+            database_id=collection['id'],
+            source_id=collection['source_id'],
+            data_version=collection['data_version'],
+            sample=collection['sample'],
+            transform_type=collection['transform_type'],
+            transform_from_collection_id=collection['transform_from_collection_id'],
+            check_data=collection['check_data'],
+            check_older_data_with_schema_version_1_1=collection['check_older_data_with_schema_version_1_1'],
+            check_level=collection['check_level'],
+            check_sample_rate=collection['check_sample_rate'],
+            check_sample_size=collection['check_sample_size'],
+            store_start_at=collection['store_start_at'],
+            store_end_at=collection['store_end_at'],
+            deleted_at=collection['deleted_at'],
+        )
 
     def get_all_notes_in_collection(self, collection_id):
         with self.get_engine().begin() as connection:
@@ -474,36 +748,48 @@ class DataBase:
                 ) for result in connection.execute(s)
             ]
 
-    def is_release_check_done(self, release_id, override_schema_version=''):
+    def is_release_check_done(self, release_id, override_schema_version='', check_level='full', checker_version=None):
         with self.get_engine().begin() as connection:
-            s = sa.sql.select([self.release_check_table.c.id]) \
-                .where((self.release_check_table.c.release_id == release_id) &
-                       (self.release_check_table.c.override_schema_version == override_schema_version))
+            s = sa.sql.select([self.release_check_result_table.c.id]) \
+                .where((self.release_check_result_table.c.release_id == release_id) &
+                       (self.release_check_result_table.c.override_schema_version == override_schema_version) &
+                       (self.release_check_result_table.c.check_level == check_level))
+            if checker_version:
+                s = s.where(self.release_check_result_table.c.checker_version == checker_version)
             result = connection.execute(s)
             if result.fetchone():
                 return True
 
             s = sa.sql.select([self.release_check_error_table.c.id]) \
                 .where((self.release_check_error_table.c.release_id == release_id) &
-                       (self.release_check_error_table.c.override_schema_version == override_schema_version))
+                       (self.release_check_error_table.c.override_schema_version == override_schema_version) &
+                       (self.release_check_error_table.c.check_level == check_level))
+            if checker_version:
+                s = s.where(self.release_check_error_table.c.checker_version == checker_version)
             result = connection.execute(s)
             if result.fetchone():
                 return True
 
         return False
 
-    def is_record_check_done(self, record_id, override_schema_version=''):
+    def is_record_check_done(self, record_id, override_schema_version='', check_level='full', checker_version=None):
         with self.get_engine().begin() as connection:
-            s = sa.sql.select([self.record_check_table.c.id]) \
-                .where((self.record_check_table.c.record_id == record_id) &
-                       (self.record_check_table.c.override_schema_version == override_schema_version))
+            s = sa.sql.select([self.record_check_result_table.c.id]) \
+                .where((self.record_check_result_table.c.record_id == record_id) &
+                       (self.record_check_result_table.c.override_schema_version == override_schema_version) &
+                       (self.record_check_result_table.c.check_level == check_level))
+            if checker_version:
+                s = s.where(self.record_check_result_table.c.checker_version == checker_version)
             result = connection.execute(s)
             if result.fetchone():
                 return True
 
             s = sa.sql.select([self.record_check_error_table.c.id]) \
                 .where((self.record_check_error_table.c.record_id == record_id) &
-                       (self.record_check_error_table.c.override_schema_version == override_schema_version))
+                       (self.record_check_error_table.c.override_schema_version == override_schema_version) &
+                       (self.record_check_error_table.c.check_level == check_level))
+            if checker_version:
+                s = s.where(self.record_check_error_table.c.checker_version == checker_version)
             result = connection.execute(s)
             if result.fetchone():
                 return True
@@ -545,6 +831,10 @@ class DataBase:
                     ).values(store_end_at=datetime.datetime.utcnow())
             )
 
+        # Rows can be committed out of order while a collection is being stored, so a check cursor might have passed
+        # some. Once the store has ended, no more rows arrive, so checks start again from the beginning one last time.
+        self.delete_check_cursors(collection_id)
+
         KINGFISHER_SIGNALS.signal('collection-store-finished').send('anonymous', collection_id=collection_id)
         return collection_id
 
@@ -643,14 +933,33 @@ class DataBase:
                 SELECT id FROM record
                 WHERE collection_id = :collection_id
             );""", collection_id)
-        self._delete_collection_run_sql("record_check", """
-            DELETE FROM record_check
+        self.delete_check_cursors(collection_id)
+        self._delete_collection_run_sql(
+            "collection_check_summary",
+            "DELETE FROM collection_check_summary WHERE collection_id = :collection_id;",
+            collection_id)
+        self._delete_collection_run_sql("record_check_validation_error", """
+            DELETE FROM record_check_validation_error
+            WHERE record_check_id IN (
+                SELECT record_check_result.id FROM record_check_result
+                JOIN record ON record.id = record_check_result.record_id
+                WHERE record.collection_id = :collection_id
+            );""", collection_id)
+        self._delete_collection_run_sql("release_check_validation_error", """
+            DELETE FROM release_check_validation_error
+            WHERE release_check_id IN (
+                SELECT release_check_result.id FROM release_check_result
+                JOIN release ON release.id = release_check_result.release_id
+                WHERE release.collection_id = :collection_id
+            );""", collection_id)
+        self._delete_collection_run_sql("record_check_result", """
+            DELETE FROM record_check_result
             WHERE record_id IN (
                 SELECT id FROM record
                 WHERE collection_id = :collection_id
             );""", collection_id)
-        self._delete_collection_run_sql("release_check", """
-            DELETE FROM release_check
+        self._delete_collection_run_sql("release_check_result", """
+            DELETE FROM release_check_result
             WHERE release_id IN (
                 SELECT id FROM release
                 WHERE collection_id = :collection_id
@@ -701,6 +1010,18 @@ class DataBase:
             "collection_file", "DELETE FROM collection_file WHERE collection_id = :collection_id;", collection_id)
         self._delete_collection_run_sql(
             "collection_note", "DELETE FROM collection_note WHERE collection_id = :collection_id;", collection_id)
+        self._delete_collection_run_sql(
+            "transform_compile_releases_queue",
+            "DELETE FROM transform_compile_releases_queue WHERE collection_id = :collection_id;",
+            collection_id)
+        self._delete_collection_run_sql(
+            "transform_compile_releases_watermark",
+            "DELETE FROM transform_compile_releases_watermark WHERE collection_id = :collection_id;",
+            collection_id)
+        self._delete_collection_run_sql(
+            "transform_upgrade_1_0_to_1_1_watermark",
+            "DELETE FROM transform_upgrade_1_0_to_1_1_watermark WHERE collection_id = :collection_id;",
+            collection_id)
         self._delete_collection_run_sql(
             "collection",
             """
@@ -738,8 +1059,32 @@ class DataBase:
                 )
 
     def delete_orphan_data(self):
+        self._delete_orphan_data_compiled_release_memo()
         self._delete_orphan_data_data()
         self._delete_orphan_data_package_data()
+        self._delete_orphan_data_check_output()
+
+    def _delete_orphan_data_compiled_release_memo(self):
+        # Compiled releases are only reused from this table while a compiled release uses them, so that they don't
+        # stop orphan data from being deleted.
+        sql_get = """
+            SELECT compiled_release_memo.hash_md5
+            FROM compiled_release_memo
+            LEFT JOIN compiled_release ON compiled_release.data_id = compiled_release_memo.data_id
+            WHERE compiled_release.data_id IS NULL
+            LIMIT 10000;
+        """
+        logger = logging.getLogger('ocdskingfisher.database.delete-collection')
+        logger.debug("Deleting compiled_release_memo")
+        while True:
+            with self.get_engine().begin() as connection:
+                hashes_to_delete = [row['hash_md5'] for row in connection.execute(sa.sql.text(sql_get))]
+                if not hashes_to_delete:
+                    return
+                connection.execute(
+                    sa.sql.text("DELETE FROM compiled_release_memo WHERE hash_md5 IN :hashes"),
+                    hashes=tuple(hashes_to_delete)
+                )
 
     def _delete_orphan_data_data(self):
         data_get = {}
@@ -786,70 +1131,390 @@ class DataBase:
                     ids=tuple(ids_to_delete)
                 )
 
-    def _get_check_query(self, obj_type, collection_id, override_schema_version):
-        data = {'collection_id': collection_id}
+    def _delete_orphan_data_check_output(self):
+        sql_get = """
+            SELECT check_output.id
+            FROM check_output
+            LEFT JOIN release_check_result ON release_check_result.check_output_id = check_output.id
+            LEFT JOIN record_check_result ON record_check_result.check_output_id = check_output.id
+            WHERE release_check_result.check_output_id IS NULL AND record_check_result.check_output_id IS NULL
+            LIMIT 10000;
+        """
+        logger = logging.getLogger('ocdskingfisher.database.delete-collection')
+        logger.debug("Deleting check_output")
+        while True:
+            with self.get_engine().begin() as connection:
+                ids_to_delete = [row['id'] for row in connection.execute(sa.sql.text(sql_get))]
+                if not ids_to_delete:
+                    return
+                connection.execute(
+                    sa.sql.text("DELETE FROM check_output WHERE id IN :ids"),
+                    ids=tuple(ids_to_delete)
+                )
+
+    def _get_check_query(self, obj_type, collection_id, override_schema_version, check_level, checker_version=None,
+                         sample_rate=None, after_id=None):
+        data = {'collection_id': collection_id, 'check_level': check_level}
         sql = """
             SELECT release.id, release.data_id, release.package_data_id
             FROM release
         """
+        # Data has been checked if there is a result or an error. If a checker version is given, only results and
+        # errors from that version count.
+        checked = "release_id = release.id AND override_schema_version = :override_schema_version" \
+                  " AND check_level = :check_level"
+        if checker_version:
+            checked += " AND checker_version = :checker_version"
+            data['checker_version'] = checker_version
+        data['override_schema_version'] = override_schema_version
         if override_schema_version:
             sql += """
                 LEFT JOIN package_data ON package_data.id = release.package_data_id
-                WHERE release.collection_id = :collection_id
-                    AND NOT EXISTS (
-                        SELECT FROM release_check
-                        WHERE release_id = release.id AND override_schema_version = :override_schema_version
-                    )
-                    AND NOT EXISTS (
-                        SELECT FROM release_check_error
-                        WHERE release_id = release.id AND override_schema_version = :override_schema_version
-                    )
-                    AND coalesce(data ->> 'version', '1.0') <> :override_schema_version;
             """
-            data['override_schema_version'] = override_schema_version
-        else:
+        sql += """
+            WHERE release.collection_id = :collection_id
+                AND NOT EXISTS (SELECT FROM release_check_result WHERE {0})
+                AND NOT EXISTS (SELECT FROM release_check_error WHERE {0})
+        """.format(checked)
+        if override_schema_version:
             sql += """
-                WHERE release.collection_id = :collection_id
-                    AND NOT EXISTS (
-                        SELECT FROM release_check
-                        WHERE release_id = release.id AND override_schema_version = ''
-                    )
-                    AND NOT EXISTS (
-                        SELECT FROM release_check_error
-                        WHERE release_id = release.id AND override_schema_version = ''
-                    );
+                AND coalesce(data ->> 'version', '1.0') <> :override_schema_version
+            """
+        if sample_rate is not None:
+            sql += """
+                AND {}
+            """.format(_get_sample_condition(':sample_rate'))
+            data['sample_rate'] = sample_rate
+        if after_id:
+            sql += """
+                AND release.id > :after_id
             """
+            data['after_id'] = after_id
+        sql += """
+            ORDER BY release.id
+        """
 
         return sql.replace('release', obj_type), data
 
-    def get_releases_to_check(self, collection_id, override_schema_version=''):
-        sql, data = self._get_check_query('release', collection_id, override_schema_version)
+    def get_releases_to_check(self, collection_id, override_schema_version='', check_level='full',
+                              checker_version=None, sample_rate=None, sample_size=None, after_id=None,
+                              batch_size=1000):
+        return self._get_to_check('release', collection_id, override_schema_version, check_level,
+                                  checker_version, sample_rate, sample_size, after_id, batch_size)
+
+    def get_records_to_check(self, collection_id, override_schema_version='', check_level='full',
+                             checker_version=None, sample_rate=None, sample_size=None, after_id=None,
+                             batch_size=1000):
+        return self._get_to_check('record', collection_id, override_schema_version, check_level,
+                                  checker_version, sample_rate, sample_size, after_id, batch_size)
+
+    def _get_sample_rate(self, obj_type, collection_id, sample_rate, sample_size):
+        """Returns the fraction of the releases or records in a collection to check, or None to check them all. A
+        sample size is converted to a rate using the number of releases or records in the collection."""
+        if sample_rate is None and sample_size is None:
+            return None
+        rate = 1 if sample_rate is None else sample_rate
+        if sample_size is not None:
+            with self.get_engine().begin() as connection:
+                s = sa.sql.text("SELECT count(*) FROM {} WHERE collection_id = :collection_id".format(obj_type))
+                count = connection.execute(s, {'collection_id': collection_id}).scalar()
+            if count:
+                rate = min(rate, sample_size / count)
+        return rate
+
+    def _get_to_check(self, obj_type, collection_id, override_schema_version, check_level, checker_version,
+                      sample_rate, sample_size, after_id, batch_size):
+        """Yields the rows to check in order of id. They are read a batch at a time, each batch after the id of the
+        last row of the one before and in its own short transaction, so that a long run of checks doesn't hold a
+        snapshot that stops vacuum from removing old rows."""
+        # The sample size is converted to a rate once, rather than counting the collection for every batch.
+        sample_rate = self._get_sample_rate(obj_type, collection_id, sample_rate, sample_size)
+        while True:
+            sql, data = self._get_check_query(obj_type, collection_id, override_schema_version, check_level,
+                                              checker_version=checker_version, sample_rate=sample_rate,
+                                              after_id=after_id)
+            sql += " LIMIT :limit "
+            data['limit'] = batch_size
+
+            with self.get_engine().begin() as connection:
+                rows = connection.execute(sa.sql.text(sql), data).fetchall()
 
+            for row in rows:
+                yield row
+
+            if len(rows) < batch_size:
+                return
+            after_id = rows[-1]['id']
+
+    def stream_rows(self, sql, data, batch_size=1000):
+        """Yields the rows of a query in order. They are fetched a batch at a time with a server-side cursor, so the
+        first rows are available at once and memory use doesn't grow with the number of rows. The transaction stays
+        open until the generator is exhausted or closed, so this is only for queries whose rows are used quickly,
+        like the data for a batch of ocids."""
         with self.get_engine().begin() as connection:
-            query = sa.sql.expression.text(sql)
-            return connection.execute(query, data)
+            result = connection.execution_options(stream_results=True).execute(sa.sql.text(sql), data)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
 
-    def get_records_to_check(self, collection_id, override_schema_version=''):
-        sql, data = self._get_check_query('record', collection_id, override_schema_version)
+    def get_compile_releases_window(self, collection_id):
+        """Returns the watermarks of the compile-releases transform into this collection, if a window is in progress.
+        All source releases and records up to release_id and record_id have been compiled. The ocids of those up to
+        next_release_id and next_record_id are in the transform_compile_releases_queue table until compiled."""
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.transform_compile_releases_watermark_table]) \
+                .where((self.transform_compile_releases_watermark_table.c.collection_id == collection_id) &
+                       self.transform_compile_releases_watermark_table.c.next_release_id.isnot(None))
+            row = connection.execute(s).fetchone()
+            return dict(row) if row else None
+
+    def start_compile_releases_window(self, collection_id, source_collection_id):
+        """Starts a window that covers the source releases and records stored since the last window, queues their
+        ocids, and returns the window like get_compile_releases_window.
+
+        Rows can be committed out of order, so a window that was started while the source collection was being stored
+        might not have seen all the rows up to its watermarks. The first window that is started after the source
+        collection has ended covers all of it again."""
+        with self.get_engine().begin() as connection:
+            window = dict(connection.execute(sa.sql.text("""
+                INSERT INTO transform_compile_releases_watermark AS watermark
+                    (collection_id, release_id, record_id, next_release_id, next_record_id, source_store_ended)
+                VALUES (
+                    :collection_id, 0, 0,
+                    coalesce((SELECT max(id) FROM release WHERE collection_id = :source_collection_id), 0),
+                    coalesce((SELECT max(id) FROM record WHERE collection_id = :source_collection_id), 0),
+                    (SELECT store_end_at IS NOT NULL FROM collection WHERE id = :source_collection_id)
+                )
+                ON CONFLICT (collection_id) DO UPDATE SET
+                    release_id = CASE
+                        WHEN EXCLUDED.source_store_ended AND NOT watermark.source_store_ended
+                        THEN 0 ELSE watermark.release_id
+                    END,
+                    record_id = CASE
+                        WHEN EXCLUDED.source_store_ended AND NOT watermark.source_store_ended
+                        THEN 0 ELSE watermark.record_id
+                    END,
+                    next_release_id = EXCLUDED.next_release_id,
+                    next_record_id = EXCLUDED.next_record_id,
+                    source_store_ended = EXCLUDED.source_store_ended
+                RETURNING *
+            """), {'collection_id': collection_id, 'source_collection_id': source_collection_id}).fetchone())
+
+            connection.execute(sa.sql.text("""
+                INSERT INTO transform_compile_releases_queue (collection_id, ocid)
+                SELECT :collection_id, ocid FROM release
+                WHERE collection_id = :source_collection_id AND id > :release_id AND id <= :next_release_id
+                UNION
+                SELECT :collection_id, ocid FROM record
+                WHERE collection_id = :source_collection_id AND id > :record_id AND id <= :next_record_id
+                ON CONFLICT DO NOTHING
+            """), dict(window, source_collection_id=source_collection_id))
+
+            return window
+
+    def end_compile_releases_window(self, collection_id):
+        with self.get_engine().begin() as connection:
+            connection.execute(sa.sql.text("""
+                UPDATE transform_compile_releases_watermark SET
+                    release_id = next_release_id,
+                    record_id = next_record_id,
+                    next_release_id = NULL,
+                    next_record_id = NULL
+                WHERE collection_id = :collection_id AND next_release_id IS NOT NULL
+            """), {'collection_id': collection_id})
+
+    def get_upgrade_1_0_to_1_1_watermark(self, collection_id):
+        """Returns the id of the last source collection file item that the upgrade transform to the given collection
+        has finished, or 0."""
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.transform_upgrade_1_0_to_1_1_watermark_table.c.collection_file_item_id]) \
+                .where(self.transform_upgrade_1_0_to_1_1_watermark_table.c.collection_id == collection_id)
+            row = connection.execute(s).fetchone()
+            return row[0] if row else 0
 
+    def set_upgrade_1_0_to_1_1_watermark(self, collection_id, collection_file_item_id):
         with self.get_engine().begin() as connection:
-            query = sa.sql.expression.text(sql)
-            return connection.execute(query, data)
+            connection.execute(sa.sql.text("""
+                INSERT INTO transform_upgrade_1_0_to_1_1_watermark (collection_id, collection_file_item_id)
+                VALUES (:collection_id, :collection_file_item_id)
+                ON CONFLICT (collection_id) DO UPDATE SET
+                    collection_file_item_id = greatest(
+                        transform_upgrade_1_0_to_1_1_watermark.collection_file_item_id,
+                        EXCLUDED.collection_file_item_id
+                    )
+            """), {'collection_id': collection_id, 'collection_file_item_id': collection_file_item_id})
 
-    def add_collection_note(self, collection_id, note):
+    def get_max_collection_file_item_id(self, collection_id):
         with self.get_engine().begin() as connection:
-            s = sa.sql.select([self.collection_note_table]) \
-                .where((self.collection_note_table.c.collection_id == collection_id) &
-                       (self.collection_note_table.c.note == note))
-            result = connection.execute(s)
+            return connection.execute(sa.sql.text("""
+                SELECT coalesce(max(collection_file_item.id), 0)
+                FROM collection_file_item
+                JOIN collection_file ON collection_file.id = collection_file_item.collection_file_id
+                WHERE collection_file.collection_id = :collection_id
+            """), {'collection_id': collection_id}).scalar()
 
-            collection_note_table_row = result.fetchone()
-            if not collection_note_table_row:
-                connection.execute(self.collection_note_table.insert(), {
-                    'collection_id': collection_id,
-                    'note': note,
-                    'stored_at': datetime.datetime.utcnow(),
-                })
+    def get_compiled_release_memo(self, hash_md5):
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.compiled_release_memo_table.c.data_id]) \
+                .where(self.compiled_release_memo_table.c.hash_md5 == hash_md5)
+            row = connection.execute(s).fetchone()
+            return row['data_id'] if row else None
+
+    def get_check_cursor(self, collection_id, data_type, override_schema_version, check_level, checker_version):
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.collection_check_cursor_table.c.last_id]) \
+                .where((self.collection_check_cursor_table.c.collection_id == collection_id) &
+                       (self.collection_check_cursor_table.c.data_type == data_type) &
+                       (self.collection_check_cursor_table.c.override_schema_version == override_schema_version) &
+                       (self.collection_check_cursor_table.c.check_level == check_level) &
+                       (self.collection_check_cursor_table.c.checker_version == checker_version))
+            row = connection.execute(s).fetchone()
+            return row['last_id'] if row else 0
+
+    def set_check_cursor(self, collection_id, data_type, override_schema_version, check_level, checker_version,
+                         last_id):
+        with self.get_engine().begin() as connection:
+            connection.execute(sa.sql.text("""
+                INSERT INTO collection_check_cursor
+                    (collection_id, data_type, override_schema_version, check_level, checker_version, last_id)
+                VALUES
+                    (:collection_id, :data_type, :override_schema_version, :check_level, :checker_version, :last_id)
+                ON CONFLICT ON CONSTRAINT unique_collection_check_cursor_identifiers DO UPDATE SET
+                    last_id = greatest(collection_check_cursor.last_id, EXCLUDED.last_id)
+            """), {
+                'collection_id': collection_id,
+                'data_type': data_type,
+                'override_schema_version': override_schema_version,
+                'check_level': check_level,
+                'checker_version': checker_version,
+                'last_id': last_id,
+            })
+
+    def delete_check_cursors(self, collection_id):
+        with self.get_engine().begin() as connection:
+            connection.execute(
+                self.collection_check_cursor_table.delete()
+                    .where(self.collection_check_cursor_table.c.collection_id == collection_id)
+            )
+
+    def store_release_check(self, collection_id, release_id, override_schema_version, cove_output, check_level='full',
+                            sampled=False, checker_version=''):
+        self._store_check('release', collection_id, release_id, override_schema_version, cove_output, check_level,
+                          sampled, checker_version)
+
+    def store_record_check(self, collection_id, record_id, override_schema_version, cove_output, check_level='full',
+                           sampled=False, checker_version=''):
+        self._store_check('record', collection_id, record_id, override_schema_version, cove_output, check_level,
+                          sampled, checker_version)
+
+    def _store_check(self, obj_type, collection_id, obj_id, override_schema_version, cove_output, check_level,
+                     sampled, checker_version):
+        result_table = getattr(self, obj_type + '_check_result_table')
+        validation_error_table = getattr(self, obj_type + '_check_validation_error_table')
+
+        # Most of CoVE's output is the same for lots of data, so that part is stored once and shared.
+        # The validation errors are specific to the data, so they are stored in their own table.
+        check_output = dict(cove_output)
+        validation_errors = check_output.pop('validation_errors', None) or []
+
+        with self.get_engine().begin() as connection:
+            check_output_id = self.get_id_for_check_output(connection, check_output)
+
+            value = connection.execute(result_table.insert(), {
+                obj_type + '_id': obj_id,
+                'override_schema_version': override_schema_version,
+                'check_level': check_level,
+                'sampled': sampled,
+                'checker_version': checker_version,
+                'check_output_id': check_output_id,
+            })
+            check_id = value.inserted_primary_key[0]
+
+            if validation_errors:
+                connection.execute(validation_error_table.insert(), [{
+                    obj_type + '_check_id': check_id,
+                    'type': validation_error.get('type'),
+                    'field': validation_error.get('field'),
+                    'description': validation_error.get('description'),
+                    'path': validation_error.get('path'),
+                    'value': validation_error.get('value'),
+                } for validation_error in validation_errors])
+
+                self._update_collection_check_summary(connection, obj_type, collection_id, obj_id,
+                                                      override_schema_version, check_level, checker_version,
+                                                      validation_errors)
+
+    def _update_collection_check_summary(self, connection, obj_type, collection_id, obj_id, override_schema_version,
+                                         check_level, checker_version, validation_errors):
+        error_counts = collections.Counter(
+            (validation_error.get('type') or '', validation_error.get('field') or '')
+            for validation_error in validation_errors
+        )
+        # Rows are updated in a consistent order, so that concurrent checks of one collection can't deadlock.
+        connection.execute(sa.sql.text("""
+            INSERT INTO collection_check_summary
+                (collection_id, data_type, override_schema_version, check_level, checker_version, type, field, count,
+                 error_count, sample_ids)
+            VALUES
+                (:collection_id, :data_type, :override_schema_version, :check_level, :checker_version, :type,
+                 :field, 1, :error_count, ARRAY[:id])
+            ON CONFLICT ON CONSTRAINT unique_collection_check_summary_identifiers DO UPDATE SET
+                count = collection_check_summary.count + 1,
+                error_count = collection_check_summary.error_count + EXCLUDED.error_count,
+                sample_ids = CASE
+                    WHEN cardinality(collection_check_summary.sample_ids) < 10
+                    THEN collection_check_summary.sample_ids || EXCLUDED.sample_ids
+                    ELSE collection_check_summary.sample_ids
+                END
+        """), [{
+            'collection_id': collection_id,
+            'data_type': obj_type,
+            'override_schema_version': override_schema_version,
+            'check_level': check_level,
+            'checker_version': checker_version,
+            'type': error_type,
+            'field': field,
+            'error_count': error_count,
+            'id': obj_id,
+        } for (error_type, field), error_count in sorted(error_counts.items())])
+
+    def get_id_for_check_output(self, connection, check_output):
+        # The hash is calculated by the database, as that is also what the migration that created this table did.
+        # If another transaction is inserting the same output at the same time, the insert does nothing and the select
+        # may not see the other row yet, so try again.
+        sql = sa.sql.text("""
+            WITH inserted AS (
+                INSERT INTO check_output (hash_md5, data)
+                VALUES (md5(CAST(:data AS jsonb)::text), CAST(:data AS jsonb))
+                ON CONFLICT (hash_md5) DO NOTHING
+                RETURNING id
+            )
+            SELECT id FROM inserted
+            UNION ALL
+            SELECT id FROM check_output WHERE hash_md5 = md5(CAST(:data AS jsonb)::text)
+        """)
+        data = SetEncoder().encode(check_output)
+        while True:
+            row = connection.execute(sql, data=data).fetchone()
+            if row:
+                return row['id']
+
+    def add_collection_note(self, collection_id, note):
+        with self.get_engine().begin() as connection:
+            self._insert_collection_notes(connection, collection_id, [note])
+
+    def _insert_collection_notes(self, connection, collection_id, notes):
+        """Inserts the notes that aren't already in the collection."""
+        stored_at = datetime.datetime.utcnow()
+        connection.execute(
+            insert(self.collection_note_table)
+            .values([{'collection_id': collection_id, 'note': note, 'stored_at': stored_at} for note in notes])
+            .on_conflict_do_nothing(index_elements=[self.collection_note_table.c.collection_id,
+                                                    sa.func.md5(self.collection_note_table.c.note)])
+        )
 
     def mark_collection_check_data(self, collection_id, value):
         with self.get_engine().begin() as connection:
@@ -867,6 +1532,25 @@ class DataBase:
                     .values(check_older_data_with_schema_version_1_1=value)
             )
 
+    def mark_collection_check_level(self, collection_id, value):
+        with self.get_engine().begin() as connection:
+            connection.execute(
+                self.collection_table.update()
+                    .where(self.collection_table.c.id == collection_id)
+                    .values(check_level=value)
+            )
+
+    def mark_collection_check_sample(self, collection_id, sample_rate=None, sample_size=None):
+        with self.get_engine().begin() as connection:
+            connection.execute(
+                self.collection_table.update()
+                    .where(self.collection_table.c.id == collection_id)
+                    .values(check_sample_rate=sample_rate, check_sample_size=sample_size)
+            )
+
+        # The check cursors have passed data that was not in the old sample.
+        self.delete_check_cursors(collection_id)
+
     def update_collection_cached_columns(self, collection_id):
         with self.get_engine().begin() as connection:
             s = sa.sql.expression.text(
@@ -909,7 +1593,9 @@ class DataBase:
 class DatabaseStore:
 
     def __init__(self, database, collection_id, file_name, number, url='', before_db_transaction_ends_callback=None,
-                 allow_existing_collection_file_item_table_row=False, warnings=None):
+                 allow_existing_collection_file_item_table_row=False, warnings=None, upgrade_collection_id=None):
+        """If upgrade_collection_id is set, each release and record is also upgraded from OCDS 1.0 to 1.1 and stored in
+        that collection, in the same transaction, as the upgrade transform would."""
         self.database = database
         self.collection_id = collection_id
         self.file_name = file_name
@@ -922,6 +1608,9 @@ class DatabaseStore:
         self.collection_file_item_id = None
         self.allow_existing_collection_file_item_table_row = allow_existing_collection_file_item_table_row
         self.warnings = warnings
+        self.upgrade_collection_id = upgrade_collection_id
+        self.upgrade_collection_file_item_id = None
+        self._upgraded_package_data_ids = {}
 
     def __enter__(self):
         self.connection = self.database.get_engine().connect()
@@ -967,6 +1656,29 @@ class DatabaseStore:
             })
             self.collection_file_item_id = value.inserted_primary_key[0]
 
+        # Upgraded Collection File Item! This may already exist, if the upgrade transform got there first.
+        if self.upgrade_collection_id:
+            self.connection.execute(
+                insert(self.database.collection_file_table)
+                .values(collection_id=self.upgrade_collection_id, filename=self.file_name, url=self.url)
+                .on_conflict_do_nothing(index_elements=['collection_id', 'filename'])
+            )
+            upgrade_collection_file_id = self.connection.execute(
+                sa.sql.select([self.database.collection_file_table.c.id])
+                .where((self.database.collection_file_table.c.collection_id == self.upgrade_collection_id) &
+                       (self.database.collection_file_table.c.filename == self.file_name))
+            ).scalar()
+            self.connection.execute(
+                insert(self.database.collection_file_item_table)
+                .values(collection_file_id=upgrade_collection_file_id, number=self.number)
+                .on_conflict_do_nothing(index_elements=['collection_file_id', 'number'])
+            )
+            self.upgrade_collection_file_item_id = self.connection.execute(
+                sa.sql.select([self.database.collection_file_item_table.c.id])
+                .where((self.database.collection_file_item_table.c.collection_file_id == upgrade_collection_file_id) &
+                       (self.database.collection_file_item_table.c.number == self.number))
+            ).scalar()
+
         # DB queries that will be used repeatably, we pre-build and reuse for speed
         self.database_get_existing_data = \
             sa.sql.expression.text("SELECT id FROM data WHERE hash_md5 = :hash_md5")
@@ -998,31 +1710,83 @@ class DatabaseStore:
                       collection_file_item_id=self.collection_file_item_id
                       )
 
+            if self.upgrade_collection_id:
+                KINGFISHER_SIGNALS\
+                    .signal('collection-data-store-finished')\
+                    .send('anonymous',
+                          collection_id=self.upgrade_collection_id,
+                          collection_file_item_id=self.upgrade_collection_file_item_id
+                          )
+
     def insert_record(self, row, package_data):
         ocid = row.get('ocid', '')
         package_data_id = self.get_id_for_package_data(package_data)
         data_id = self.get_id_for_data(row)
-        self.connection.execute(self.database.record_table.insert(), {
+        row_id = self.connection.execute(self.database.record_table.insert(), {
             'collection_id': self.collection_id,
             'collection_file_item_id': self.collection_file_item_id,
             'ocid': ocid,
             'data_id': data_id,
             'package_data_id': package_data_id,
-        })
+        }).inserted_primary_key[0]
+
+        if self.upgrade_collection_id:
+            data_id, package_data_id = self._get_upgraded_ids('record', row, data_id, package_data, package_data_id)
+            self.connection.execute(self.database.record_table.insert(), {
+                'collection_id': self.upgrade_collection_id,
+                'collection_file_item_id': self.upgrade_collection_file_item_id,
+                'ocid': ocid,
+                'data_id': data_id,
+                'package_data_id': package_data_id,
+            })
+            self.connection.execute(self.database.transform_upgrade_1_0_to_1_1_status_record_table.insert(), {
+                'source_record_id': row_id,
+            })
 
     def insert_release(self, row, package_data):
         ocid = row.get('ocid', '')
         release_id = row.get('id', '')
         package_data_id = self.get_id_for_package_data(package_data)
         data_id = self.get_id_for_data(row)
-        self.connection.execute(self.database.release_table.insert(), {
+        row_id = self.connection.execute(self.database.release_table.insert(), {
             'collection_id': self.collection_id,
             'collection_file_item_id': self.collection_file_item_id,
             'release_id': release_id,
             'ocid': ocid,
             'data_id': data_id,
             'package_data_id': package_data_id,
-        })
+        }).inserted_primary_key[0]
+
+        if self.upgrade_collection_id:
+            data_id, package_data_id = self._get_upgraded_ids('release', row, data_id, package_data, package_data_id)
+            self.connection.execute(self.database.release_table.insert(), {
+                'collection_id': self.upgrade_collection_id,
+                'collection_file_item_id': self.upgrade_collection_file_item_id,
+                'release_id': release_id,
+                'ocid': ocid,
+                'data_id': data_id,
+                'package_data_id': package_data_id,
+            })
+            self.connection.execute(self.database.transform_upgrade_1_0_to_1_1_status_release_table.insert(), {
+                'source_release_id': row_id,
+            })
+
+    def _get_upgraded_ids(self, obj_type, row, data_id, package_data, package_data_id):
+        """Upgrades a release or record and its package data, and returns the ids of the upgraded data and package
+        data. Like the upgrade transform, data in a 1.1 package is unchanged, and is stored as is."""
+        if package_data.get('version') == '1.1':
+            return data_id, package_data_id
+
+        # upgrade_10_11 changes the data in place, and needs an OrderedDict.
+        package = json.loads(json.dumps(package_data), object_pairs_hook=collections.OrderedDict)
+        package[obj_type + 's'] = [json.loads(json.dumps(row), object_pairs_hook=collections.OrderedDict)]
+        package = upgrade_10_11(package)
+
+        upgraded_row = package.pop(obj_type + 's')[0]
+        # Every release or record in an item has the same package data.
+        if package_data_id not in self._upgraded_package_data_ids:
+            self._upgraded_package_data_ids[package_data_id] = self.get_id_for_package_data(package)
+        return self.get_id_for_data(upgraded_row), self._upgraded_package_data_ids[package_data_id]
 
     def insert_compiled_release(self, row):
         ocid = row.get('ocid', '')
@@ -1059,3 +1823,358 @@ class DatabaseStore:
                 'hash_md5': hash_md5,
                 'data': data,
             }).inserted_primary_key[0]
+
+
+def _get_sample_condition(sample_rate):
+    """Returns an SQL condition that is true for the releases in a check sample. The argument is an SQL expression.
+
+    Whether a release is in the sample depends on a hash of its id, so the same sample is taken each time, and the
+    sample can be found without ranking the whole collection."""
+    return "('x' || left(md5(release.id::text), 8))::bit(32)::bigint < 4294967296 * {}".format(sample_rate)
+
+
+def _get_sample_rate_expression(obj_type):
+    """Returns an SQL expression for a collection's sample rate for releases or records, like
+    DataBase._get_sample_rate. The releases or records are only counted if the collection has a sample size."""
+    return """
+        CASE WHEN collection.check_sample_size IS NULL THEN collection.check_sample_rate
+        ELSE least(coalesce(collection.check_sample_rate, 1), coalesce(collection.check_sample_size / nullif((
+            SELECT count(*) FROM {0} WHERE {0}.collection_id = collection.id
+        ), 0)::float, 1)) END
+    """.format(obj_type)
+
+
+def _get_ids_for_data(connection, table, data):
+    """Stores the values of the data dict in the data or package_data table, if they aren't already stored. The keys of
+    the data dict are the hashes of the values. Returns a dict of hashes to ids."""
+    if not data:
+        return {}
+    # The rows are inserted in order of hash, so that concurrent inserts lock them in the same order, and don't
+    # deadlock.
+    connection.execute(
+        insert(table)
+        .values([{'hash_md5': hash_md5, 'data': value} for hash_md5, value in sorted(data.items())])
+        .on_conflict_do_nothing(index_elements=['hash_md5'])
+    )
+    result = connection.execute(sa.sql.select([table.c.id, table.c.hash_md5]).where(table.c.hash_md5.in_(list(data))))
+    return {row['hash_md5']: row['id'] for row in result}
+
+
+class UpgradeBulkStore:
+    """Stores the releases or records that the upgrade transform upgraded, a batch at a time, instead of using a
+    DatabaseStore and a transaction for each one. Each batch is stored in one transaction, with the rows in the
+    transform_upgrade_1_0_to_1_1_status_release or transform_upgrade_1_0_to_1_1_status_record table. Like
+    DatabaseStore, each is stored in a collection file and item with the same filename and number as in the source
+    collection, which may already exist. If a source release or record already has a status row, it has already been
+    upgraded (for example, by a concurrent transform), and it is skipped.
+
+    After each batch is stored, stored_ids has the data_id and package_data_id of each release or record that was
+    stored, by source_id.
+
+    Use as a context manager, so that the last batch is stored."""
+
+    def __init__(self, database, collection_id, obj_type, batch_size=1000):
+        self.database = database
+        self.collection_id = collection_id
+        self.obj_type = obj_type
+        self.batch_size = batch_size
+        self.stored_ids = {}
+        self._items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not type:
+            self.flush()
+
+    def add(self, source_id, file_name, url, number, data, package_data, data_id=None, package_data_id=None,
+            ocid='', release_id=''):
+        """Adds an upgraded release or record. source_id is the id of the release or record in the source collection.
+
+        If data_id is set, the release or record is the existing data with that id, and data is ignored. In that case,
+        ocid and (for releases) release_id are stored as given. Likewise, if package_data_id is set, package_data is
+        ignored."""
+        item = {
+            'source_id': source_id,
+            'file_name': file_name,
+            'url': url,
+            'number': number,
+            'data_id': data_id,
+            'package_data_id': package_data_id,
+        }
+        if data_id:
+            item.update({'ocid': ocid, 'release_id': release_id})
+        else:
+            item.update({
+                'ocid': data.get('ocid', ''),
+                'release_id': data.get('id', ''),
+                'data': data,
+                'hash_md5': get_hash_md5_for_data(data),
+            })
+        if not package_data_id:
+            item.update({
+                'package_data': package_data,
+                'package_data_hash_md5': get_hash_md5_for_data(package_data),
+            })
+        self._items.append(item)
+        if len(self._items) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._items:
+            return
+
+        items = self._items
+        self._items = []
+
+        table = getattr(self.database, self.obj_type + '_table')
+        status_table = getattr(self.database, 'transform_upgrade_1_0_to_1_1_status_' + self.obj_type + '_table')
+        status_column = status_table.c['source_' + self.obj_type + '_id']
+
+        # Like in _get_ids_for_data, the rows are inserted in order of their unique keys, so that concurrent inserts
+        # lock them in the same order, and don't deadlock.
+        with self.database.get_engine().begin() as connection:
+            result = connection.execute(
+                insert(status_table)
+                .values([{status_column.name: source_id} for source_id in sorted(item['source_id'] for item in items)])
+                .on_conflict_do_nothing()
+                .returning(status_column)
+            )
+            source_ids = {row[0] for row in result}
+            items = [item for item in items if item['source_id'] in source_ids]
+            if not items:
+                return
+
+            collection_files = {item['file_name']: item['url'] for item in items}
+            connection.execute(
+                insert(self.database.collection_file_table)
+                .values([{'collection_id': self.collection_id, 'filename': file_name, 'url': url}
+                         for file_name, url in sorted(collection_files.items())])
+                .on_conflict_do_nothing(index_elements=['collection_id', 'filename'])
+            )
+            result = connection.execute(
+                sa.sql.select([self.database.collection_file_table.c.id,
+                               self.database.collection_file_table.c.filename])
+                .where((self.database.collection_file_table.c.collection_id == self.collection_id) &
+                       (self.database.collection_file_table.c.filename.in_(list(collection_files))))
+            )
+            collection_file_ids = {row['filename']: row['id'] for row in result}
+
+            keys = {(collection_file_ids[item['file_name']], item['number']) for item in items}
+            connection.execute(
+                insert(self.database.collection_file_item_table)
+                .values([{'collection_file_id': collection_file_id, 'number': number}
+                         for collection_file_id, number in sorted(keys)])
+                .on_conflict_do_nothing(index_elements=['collection_file_id', 'number'])
+            )
+            result = connection.execute(
+                sa.sql.select([self.database.collection_file_item_table])
+                .where(sa.tuple_(self.database.collection_file_item_table.c.collection_file_id,
+                                 self.database.collection_file_item_table.c.number).in_(list(keys)))
+            )
+            collection_file_item_ids = {(row['collection_file_id'], row['number']): row['id'] for row in result}
+
+            data_ids = _get_ids_for_data(connection, self.database.data_table,
+                                         {item['hash_md5']: item['data'] for item in items if 'data' in item})
+            package_data_ids = _get_ids_for_data(connection, self.database.package_data_table, {
+                item['package_data_hash_md5']: item['package_data'] for item in items if 'package_data' in item
+            })
+
+            rows = []
+            for item in items:
+                row = {
+                    'collection_id': self.collection_id,
+                    'collection_file_item_id': collection_file_item_ids[
+                        (collection_file_ids[item['file_name']], item['number'])],
+                    'ocid': item['ocid'],
+                    'data_id': item['data_id'] or data_ids[item['hash_md5']],
+                    'package_data_id': item['package_data_id'] or package_data_ids[item['package_data_hash_md5']],
+                }
+                if self.obj_type == 'release':
+                    row['release_id'] = item['release_id']
+                rows.append(row)
+            connection.execute(table.insert().values(rows))
+
+        for item, row in zip(items, rows):
+            self.stored_ids[item['source_id']] = (row['data_id'], row['package_data_id'])
+
+        # Only now that the transaction is committed can others see the data.
+        for collection_file_item_id in sorted({row['collection_file_item_id'] for row in rows}):
+            KINGFISHER_SIGNALS\
+                .signal('collection-data-store-finished')\
+                .send('anonymous',
+                      collection_id=self.collection_id,
+                      collection_file_item_id=collection_file_item_id
+                      )
+
+
+class CompiledReleaseBulkStore:
+    """Stores compiled releases a batch at a time, instead of using a DatabaseStore and a transaction for each one.
+    Each batch is stored in one transaction, with one multi-row INSERT for each table. Like DatabaseStore, each
+    compiled release has its own collection file, named after its ocid. If a collection file already exists, the ocid
+    has already been compiled (for example, by a concurrent transform), and it is skipped - unless replace is true, in
+    which case the existing compiled release is deleted.
+
+    Use as a context manager, so that the last batch is stored."""
+
+    def __init__(self, database, collection_id, batch_size=1000, replace=False):
+        self.database = database
+        self.collection_id = collection_id
+        self.batch_size = batch_size
+        self.replace = replace
+        self._items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not type:
+            self.flush()
+
+    def add(self, ocid, data, warnings=None, data_id=None, memo_key=None):
+        """Adds a compiled release. If data_id is set, the compiled release is the existing data with that id, and data
+        is ignored. If memo_key is set, the data is stored in the compiled_release_memo table with that key."""
+        if data_id:
+            item = {'ocid': ocid, 'data_id': data_id}
+        else:
+            item = {'ocid': data.get('ocid', ''), 'data': data, 'hash_md5': get_hash_md5_for_data(data)}
+        item.update({
+            'filename': ocid + '.json',
+            'warnings': warnings if isinstance(warnings, list) and len(warnings) > 0 else None,
+            'memo_key': memo_key,
+        })
+        self._items.append(item)
+        if len(self._items) >= self.batch_size:
+            self.flush()
+
+    def _get_replace_queries(self, filenames):
+        """Returns the statements that delete the compiled releases in the given collection files, and the files."""
+        return [
+            """
+                DELETE FROM compiled_release
+                USING collection_file_item, collection_file
+                WHERE compiled_release.collection_file_item_id = collection_file_item.id
+                    AND collection_file_item.collection_file_id = collection_file.id
+                    AND collection_file.collection_id = :collection_id
+                    AND collection_file.filename IN :filenames
+            """,
+            """
+                DELETE FROM collection_file_item
+                USING collection_file
+                WHERE collection_file_item.collection_file_id = collection_file.id
+                    AND collection_file.collection_id = :collection_id
+                    AND collection_file.filename IN :filenames
+            """,
+            """
+                DELETE FROM collection_file
+                WHERE collection_id = :collection_id AND filename IN :filenames
+            """,
+        ], {'collection_id': self.collection_id, 'filenames': tuple(filenames)}
+
+    def flush(self):
+        if not self._items:
+            return
+
+        # Duplicates within a batch are handled in the same way as duplicates already in the database. Like in
+        # _get_ids_for_data, the rows are inserted in order of their unique keys, so that concurrent inserts lock them
+        # in the same order, and don't deadlock.
+        items = sorted({item['filename']: item for item in reversed(self._items)}.values(),
+                       key=lambda item: item['filename'])
+        self._items = []
+
+        with self.database.get_engine().begin() as connection:
+            if self.replace:
+                statements, params = self._get_replace_queries(item['filename'] for item in items)
+                for sql in statements:
+                    connection.execute(sa.sql.text(sql), params)
+
+            result = connection.execute(
+                insert(self.database.collection_file_table)
+                .values([{'collection_id': self.collection_id, 'filename': item['filename'], 'url': ''}
+                         for item in items])
+                .on_conflict_do_nothing(index_elements=['collection_id', 'filename'])
+                .returning(self.database.collection_file_table.c.id, self.database.collection_file_table.c.filename)
+            )
+            collection_file_ids = {row['filename']: row['id'] for row in result}
+            items = [item for item in items if item['filename'] in collection_file_ids]
+            if not items:
+                return
+
+            result = connection.execute(
+                insert(self.database.collection_file_item_table)
+                .values([{'collection_file_id': collection_file_ids[item['filename']], 'number': 1,
+                          'warnings': item['warnings']} for item in items])
+                .returning(self.database.collection_file_item_table.c.id,
+                           self.database.collection_file_item_table.c.collection_file_id)
+            )
+            collection_file_item_ids = {row['collection_file_id']: row['id'] for row in result}
+
+            data_ids = _get_ids_for_data(connection, self.database.data_table,
+                                         {item['hash_md5']: item['data'] for item in items if 'data' in item})
+
+            for item in items:
+                item['collection_file_item_id'] = collection_file_item_ids[collection_file_ids[item['filename']]]
+                if 'data' in item:
+                    item['data_id'] = data_ids[item['hash_md5']]
+
+            memos = {item['memo_key']: item['data_id'] for item in items if item['memo_key']}
+            if memos:
+                connection.execute(
+                    insert(self.database.compiled_release_memo_table)
+                    .values([{'hash_md5': memo_key, 'data_id': data_id}
+                             for memo_key, data_id in sorted(memos.items())])
+                    .on_conflict_do_nothing(index_elements=['hash_md5'])
+                )
+
+            connection.execute(self.database.compiled_release_table.insert().values([{
+                'collection_id': self.collection_id,
+                'collection_file_item_id': item['collection_file_item_id'],
+                'ocid': item['ocid'],
+                'data_id': item['data_id'],
+            } for item in items]))
+
+        # Only now that the transaction is committed can others see the data.
+        for item in items:
+            KINGFISHER_SIGNALS\
+                .signal('collection-data-store-finished')\
+                .send('anonymous',
+                      collection_id=self.collection_id,
+                      collection_file_item_id=item['collection_file_item_id']
+                      )
+
+
+class CollectionNoteBulkStore:
+    """Stores collection notes a batch at a time, for code that can add a note for each item, like transforms. Like
+    add_collection_note, a note that is already in the collection is skipped.
+
+    Use as a context manager, so that the last batch is stored."""
+
+    def __init__(self, database, collection_id, batch_size=1000):
+        self.database = database
+        self.collection_id = collection_id
+        self.batch_size = batch_size
+        self._notes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not type:
+            self.flush()
+
+    def add(self, note):
+        self._notes.append(note)
+        if len(self._notes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._notes:
+            return
+
+        # Duplicates within a batch are removed, keeping the order.
+        notes = list(dict.fromkeys(self._notes))
+        self._notes = []
+
+        with self.database.get_engine().begin() as connection:
+            self.database._insert_collection_notes(connection, self.collection_id, notes)
@@ -0,0 +1,115 @@
+"""Check levels
+
+Revision ID: 3b7e0c9d41a2
+Revises: a04f0a6fd7c2
+Create Date: 2026-10-18 12:20:44.603127
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3b7e0c9d41a2'
+down_revision = 'a04f0a6fd7c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('collection', sa.Column('check_level', sa.Text, nullable=False, server_default='full'))
+
+    for obj_type in ('release', 'record'):
+        for table in (obj_type + '_check_result', obj_type + '_check_error'):
+            op.add_column(table, sa.Column('check_level', sa.Text, nullable=False, server_default='full'))
+
+        op.drop_constraint('unique_' + obj_type + '_check_' + obj_type + '_id_and_more', obj_type + '_check_result')
+        op.create_unique_constraint('unique_' + obj_type + '_check_' + obj_type + '_id_and_more',
+                                    obj_type + '_check_result',
+                                    [obj_type + '_id', 'override_schema_version', 'check_level'])
+
+        op.drop_constraint('unique_' + obj_type + '_check_error_' + obj_type + '_id_and_more',
+                           obj_type + '_check_error')
+        op.create_unique_constraint('unique_' + obj_type + '_check_error_' + obj_type + '_id_and_more',
+                                    obj_type + '_check_error',
+                                    [obj_type + '_id', 'override_schema_version', 'check_level'])
+
+        op.execute("""
+            CREATE OR REPLACE VIEW {0}_check AS
+            SELECT
+                {0}_check_result.id,
+                {0}_check_result.{0}_id,
+                {0}_check_result.override_schema_version,
+                check_output.data || jsonb_build_object('validation_errors', coalesce((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'type', e.type,
+                        'field', e.field,
+                        'description', e.description,
+                        'path', e.path,
+                        'value', e.value
+                    ) ORDER BY e.id)
+                    FROM {0}_check_validation_error AS e
+                    WHERE e.{0}_check_id = {0}_check_result.id
+                ), '[]'::jsonb)) AS cove_output,
+                {0}_check_result.check_level
+            FROM {0}_check_result
+            JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+        """.format(obj_type))
+
+    op.add_column('collection_check_summary',
+                  sa.Column('check_level', sa.Text, nullable=False, server_default='full'))
+    op.drop_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary')
+    op.create_unique_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary',
+                                ['collection_id', 'data_type', 'override_schema_version', 'check_level', 'type',
+                                 'field'])
+
+
+def downgrade():
+    # Only the results of full checks can be kept.
+    op.execute("DELETE FROM collection_check_summary WHERE check_level <> 'full'")
+    op.drop_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary')
+    op.drop_column('collection_check_summary', 'check_level')
+    op.create_unique_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary',
+                                ['collection_id', 'data_type', 'override_schema_version', 'type', 'field'])
+
+    for obj_type in ('release', 'record'):
+        op.execute("""
+            DELETE FROM {0}_check_validation_error USING {0}_check_result
+            WHERE {0}_check_result.id = {0}_check_validation_error.{0}_check_id
+                AND {0}_check_result.check_level <> 'full'
+        """.format(obj_type))
+        op.execute("DELETE FROM {0}_check_result WHERE check_level <> 'full'".format(obj_type))
+        op.execute("DELETE FROM {0}_check_error WHERE check_level <> 'full'".format(obj_type))
+
+        # A column can't be removed from a view with CREATE OR REPLACE VIEW.
+        op.execute("DROP VIEW {0}_check".format(obj_type))
+        op.execute("""
+            CREATE VIEW {0}_check AS
+            SELECT
+                {0}_check_result.id,
+                {0}_check_result.{0}_id,
+                {0}_check_result.override_schema_version,
+                check_output.data || jsonb_build_object('validation_errors', coalesce((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'type', e.type,
+                        'field', e.field,
+                        'description', e.description,
+                        'path', e.path,
+                        'value', e.value
+                    ) ORDER BY e.id)
+                    FROM {0}_check_validation_error AS e
+                    WHERE e.{0}_check_id = {0}_check_result.id
+                ), '[]'::jsonb)) AS cove_output
+            FROM {0}_check_result
+            JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+        """.format(obj_type))
+
+        for table in (obj_type + '_check_result', obj_type + '_check_error'):
+            op.drop_column(table, 'check_level')
+        op.create_unique_constraint('unique_' + obj_type + '_check_' + obj_type + '_id_and_more',
+                                    obj_type + '_check_result',
+                                    [obj_type + '_id', 'override_schema_version'])
+        op.create_unique_constraint('unique_' + obj_type + '_check_error_' + obj_type + '_id_and_more',
+                                    obj_type + '_check_error',
+                                    [obj_type + '_id', 'override_schema_version'])
+
+    op.drop_column('collection', 'check_level')
@@ -0,0 +1,29 @@
+"""Indexes on collection_id and ocid together, for looking up the data for an ocid in one collection
+
+Revision ID: 3b8e6f2a9d41
+Revises: 9e4c1d7b3a62
+Create Date: 2026-10-18 19:21:43.608127
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3b8e6f2a9d41'
+down_revision = '9e4c1d7b3a62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # These tables are large, so the indexes are built without locking out writes. CREATE INDEX CONCURRENTLY can't run
+    # in a transaction. If it fails, it leaves an invalid index, which has to be dropped before running this again.
+    with op.get_context().autocommit_block():
+        for table in ('release', 'record', 'compiled_release'):
+            op.create_index(table + '_collection_id_ocid_idx', table, ['collection_id', 'ocid'],
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in ('release', 'record', 'compiled_release'):
+            op.drop_index(table + '_collection_id_ocid_idx', table_name=table, postgresql_concurrently=True)
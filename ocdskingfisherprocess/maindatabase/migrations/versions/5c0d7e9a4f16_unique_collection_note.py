@@ -0,0 +1,32 @@
+"""Unique index on notes in each collection, by hash
+
+Revision ID: 5c0d7e9a4f16
+Revises: 3b8e6f2a9d41
+Create Date: 2026-10-18 19:58:02.734519
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5c0d7e9a4f16'
+down_revision = '3b8e6f2a9d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Notes were only added if they weren't already in the collection, but concurrent runs could add them twice.
+    op.execute("""
+        DELETE FROM collection_note
+        USING collection_note AS earlier
+        WHERE earlier.collection_id = collection_note.collection_id
+            AND md5(earlier.note) = md5(collection_note.note)
+            AND earlier.id < collection_note.id
+    """)
+    op.create_index('unique_collection_note_identifiers', 'collection_note',
+                    ['collection_id', sa.text('md5(note)')], unique=True)
+
+
+def downgrade():
+    op.drop_index('unique_collection_note_identifiers')
@@ -0,0 +1,101 @@
+"""Record the version of the checks that produced each result
+
+Revision ID: 5d21c8e0f3b7
+Revises: af729cc5248a
+Create Date: 2026-10-18 13:48:27.205516
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d21c8e0f3b7'
+down_revision = 'af729cc5248a'
+branch_labels = None
+depends_on = None
+
+
+def _create_view(obj_type, with_checker_version):
+    op.execute("""
+        CREATE OR REPLACE VIEW {0}_check AS
+        SELECT
+            {0}_check_result.id,
+            {0}_check_result.{0}_id,
+            {0}_check_result.override_schema_version,
+            check_output.data || jsonb_build_object('validation_errors', coalesce((
+                SELECT jsonb_agg(jsonb_build_object(
+                    'type', e.type,
+                    'field', e.field,
+                    'description', e.description,
+                    'path', e.path,
+                    'value', e.value
+                ) ORDER BY e.id)
+                FROM {0}_check_validation_error AS e
+                WHERE e.{0}_check_id = {0}_check_result.id
+            ), '[]'::jsonb)) AS cove_output,
+            {0}_check_result.check_level,
+            {0}_check_result.sampled{1}
+        FROM {0}_check_result
+        JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+    """.format(obj_type, ',\n            {0}_check_result.checker_version'.format(obj_type)
+               if with_checker_version else ''))
+
+
+def upgrade():
+    # Existing results have an unknown version, so they will be checked again by the current version.
+    for obj_type in ('release', 'record'):
+        for table, constraint in ((obj_type + '_check_result', 'unique_{0}_check_{0}_id_and_more'),
+                                  (obj_type + '_check_error', 'unique_{0}_check_error_{0}_id_and_more')):
+            constraint = constraint.format(obj_type)
+            op.add_column(table, sa.Column('checker_version', sa.Text, nullable=False, server_default=''))
+            op.drop_constraint(constraint, table)
+            op.create_unique_constraint(constraint, table, [obj_type + '_id', 'override_schema_version',
+                                                            'check_level', 'checker_version'])
+
+        _create_view(obj_type, True)
+
+    op.add_column('collection_check_summary',
+                  sa.Column('checker_version', sa.Text, nullable=False, server_default=''))
+    op.drop_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary')
+    op.create_unique_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary',
+                                ['collection_id', 'data_type', 'override_schema_version', 'check_level',
+                                 'checker_version', 'type', 'field'])
+
+
+def downgrade():
+    # Only the latest result for each piece of data can be kept.
+    op.execute("""
+        DELETE FROM collection_check_summary AS a USING collection_check_summary AS b
+        WHERE a.collection_id = b.collection_id AND a.data_type = b.data_type
+            AND a.override_schema_version = b.override_schema_version AND a.check_level = b.check_level
+            AND a.type = b.type AND a.field = b.field AND a.id < b.id
+    """)
+    op.drop_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary')
+    op.drop_column('collection_check_summary', 'checker_version')
+    op.create_unique_constraint('unique_collection_check_summary_identifiers', 'collection_check_summary',
+                                ['collection_id', 'data_type', 'override_schema_version', 'check_level', 'type',
+                                 'field'])
+
+    for obj_type in ('release', 'record'):
+        op.execute("""
+            DELETE FROM {0}_check_validation_error USING {0}_check_result AS a, {0}_check_result AS b
+            WHERE {0}_check_validation_error.{0}_check_id = a.id
+                AND a.{0}_id = b.{0}_id AND a.override_schema_version = b.override_schema_version
+                AND a.check_level = b.check_level AND a.id < b.id
+        """.format(obj_type))
+        for table in (obj_type + '_check_result', obj_type + '_check_error'):
+            op.execute("""
+                DELETE FROM {1} AS a USING {1} AS b
+                WHERE a.{0}_id = b.{0}_id AND a.override_schema_version = b.override_schema_version
+                    AND a.check_level = b.check_level AND a.id < b.id
+            """.format(obj_type, table))
+
+        # A column can't be removed from a view with CREATE OR REPLACE VIEW.
+        op.execute("DROP VIEW {0}_check".format(obj_type))
+        _create_view(obj_type, False)
+
+        for table, constraint in ((obj_type + '_check_result', 'unique_{0}_check_{0}_id_and_more'),
+                                  (obj_type + '_check_error', 'unique_{0}_check_error_{0}_id_and_more')):
+            op.drop_column(table, 'checker_version')
+            op.create_unique_constraint(constraint.format(obj_type), table,
+                                        [obj_type + '_id', 'override_schema_version', 'check_level'])
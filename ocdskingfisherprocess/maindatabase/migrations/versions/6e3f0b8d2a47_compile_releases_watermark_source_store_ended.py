@@ -0,0 +1,24 @@
+"""Compile all of the source collection again once it has ended
+
+Revision ID: 6e3f0b8d2a47
+Revises: d4b7a9e2c815
+Create Date: 2026-10-18 23:48:06.572194
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6e3f0b8d2a47'
+down_revision = 'd4b7a9e2c815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transform_compile_releases_watermark',
+                  sa.Column('source_store_ended', sa.Boolean, nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    op.drop_column('transform_compile_releases_watermark', 'source_store_ended')
@@ -0,0 +1,40 @@
+"""Queue of ocids to compile
+
+Revision ID: 7f3a9b5d2c18
+Revises: c2d84f6a1e07
+Create Date: 2026-10-18 18:03:51.662940
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7f3a9b5d2c18'
+down_revision = 'c2d84f6a1e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('transform_compile_releases_queue',
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey('collection.id',
+                                            name='fk_transform_compile_releases_queue_collection_id'),
+                              nullable=False, primary_key=True),
+                    sa.Column('ocid', sa.Text, nullable=False, primary_key=True),
+                    )
+
+    # Windows in progress have no queue, so start them again.
+    op.execute("""
+        UPDATE transform_compile_releases_watermark SET next_release_id = NULL, next_record_id = NULL
+    """)
+    op.drop_column('transform_compile_releases_watermark', 'next_compiled_release_id')
+
+
+def downgrade():
+    op.add_column('transform_compile_releases_watermark',
+                  sa.Column('next_compiled_release_id', sa.Integer, nullable=True))
+    op.execute("""
+        UPDATE transform_compile_releases_watermark SET next_release_id = NULL, next_record_id = NULL
+    """)
+    op.drop_table('transform_compile_releases_queue')
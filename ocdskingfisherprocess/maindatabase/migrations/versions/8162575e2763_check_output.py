@@ -0,0 +1,126 @@
+"""Store CoVE's output content-addressed, with validation errors in their own tables
+
+Revision ID: 8162575e2763
+Revises: f8593a57e002
+Create Date: 2026-10-18 10:12:31.417350
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = '8162575e2763'
+down_revision = 'f8593a57e002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('check_output',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('hash_md5', sa.Text, nullable=False),
+                    sa.Column('data', JSONB, nullable=False),
+                    sa.UniqueConstraint('hash_md5', name='unique_check_output_hash_md5'),
+                    )
+
+    for obj_type in ('release', 'record'):
+        op.rename_table(obj_type + '_check', obj_type + '_check_result')
+        op.add_column(obj_type + '_check_result',
+                      sa.Column('check_output_id', sa.Integer,
+                                sa.ForeignKey('check_output.id',
+                                              name='fk_' + obj_type + '_check_result_check_output_id'),
+                                nullable=True))
+
+        op.create_table(obj_type + '_check_validation_error',
+                        sa.Column('id', sa.Integer, primary_key=True),
+                        sa.Column(obj_type + '_check_id', sa.Integer,
+                                  sa.ForeignKey(obj_type + '_check_result.id',
+                                                name='fk_' + obj_type + '_check_validation_error_' + obj_type +
+                                                     '_check_id'),
+                                  nullable=False),
+                        sa.Column('type', sa.Text, nullable=True),
+                        sa.Column('field', sa.Text, nullable=True),
+                        sa.Column('description', sa.Text, nullable=True),
+                        sa.Column('path', sa.Text, nullable=True),
+                        sa.Column('value', JSONB, nullable=True),
+                        sa.Index(obj_type + '_check_validation_error_' + obj_type + '_check_id_idx',
+                                 obj_type + '_check_id'),
+                        )
+
+        # Move the validation errors out, keeping their order.
+        op.execute("""
+            INSERT INTO {0}_check_validation_error ({0}_check_id, type, field, description, path, value)
+            SELECT {0}_check_result.id, e.value ->> 'type', e.value ->> 'field', e.value ->> 'description',
+                e.value ->> 'path', e.value -> 'value'
+            FROM {0}_check_result
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE jsonb_typeof(cove_output -> 'validation_errors')
+                    WHEN 'array' THEN cove_output -> 'validation_errors'
+                    ELSE '[]'::jsonb
+                END
+            ) WITH ORDINALITY AS e
+            ORDER BY {0}_check_result.id, e.ordinality
+        """.format(obj_type))
+
+        # The rest of the output is mostly the same for every row, so store each distinct value once.
+        # The hash is calculated by the database so that DataBase.get_id_for_check_output agrees with it.
+        op.execute("""
+            INSERT INTO check_output (hash_md5, data)
+            SELECT DISTINCT ON (hash_md5) hash_md5, data FROM (
+                SELECT md5((cove_output - 'validation_errors')::text) AS hash_md5,
+                    cove_output - 'validation_errors' AS data
+                FROM {0}_check_result
+            ) AS outputs
+            ON CONFLICT (hash_md5) DO NOTHING
+        """.format(obj_type))
+        op.execute("""
+            UPDATE {0}_check_result SET check_output_id = check_output.id
+            FROM check_output
+            WHERE check_output.hash_md5 = md5(({0}_check_result.cove_output - 'validation_errors')::text)
+        """.format(obj_type))
+
+        op.alter_column(obj_type + '_check_result', 'check_output_id', nullable=False)
+        op.drop_column(obj_type + '_check_result', 'cove_output')
+        op.create_index(obj_type + '_check_result_check_output_id_idx', obj_type + '_check_result',
+                        ['check_output_id'])
+
+        # Existing queries on release_check and record_check keep working.
+        op.execute("""
+            CREATE VIEW {0}_check AS
+            SELECT
+                {0}_check_result.id,
+                {0}_check_result.{0}_id,
+                {0}_check_result.override_schema_version,
+                check_output.data || jsonb_build_object('validation_errors', coalesce((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'type', e.type,
+                        'field', e.field,
+                        'description', e.description,
+                        'path', e.path,
+                        'value', e.value
+                    ) ORDER BY e.id)
+                    FROM {0}_check_validation_error AS e
+                    WHERE e.{0}_check_id = {0}_check_result.id
+                ), '[]'::jsonb)) AS cove_output
+            FROM {0}_check_result
+            JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+        """.format(obj_type))
+
+
+def downgrade():
+    for obj_type in ('release', 'record'):
+        op.add_column(obj_type + '_check_result', sa.Column('cove_output', JSONB, nullable=True))
+        op.execute("""
+            UPDATE {0}_check_result SET cove_output = {0}_check.cove_output
+            FROM {0}_check
+            WHERE {0}_check.id = {0}_check_result.id
+        """.format(obj_type))
+        op.execute("DROP VIEW {0}_check".format(obj_type))
+        op.drop_table(obj_type + '_check_validation_error')
+        op.drop_index(obj_type + '_check_result_check_output_id_idx')
+        op.drop_column(obj_type + '_check_result', 'check_output_id')
+        op.alter_column(obj_type + '_check_result', 'cove_output', nullable=False)
+        op.rename_table(obj_type + '_check_result', obj_type + '_check')
+
+    op.drop_table('check_output')
@@ -0,0 +1,29 @@
+"""Watermark for upgrading data from 1.0 to 1.1 while the source collection is being stored
+
+Revision ID: 8a2f4c6e1b93
+Revises: 5c0d7e9a4f16
+Create Date: 2026-10-18 21:04:37.915426
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8a2f4c6e1b93'
+down_revision = '5c0d7e9a4f16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('transform_upgrade_1_0_to_1_1_watermark',
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey('collection.id',
+                                            name='fk_transform_upgrade_1_0_to_1_1_watermark_collection_id'),
+                              nullable=False, primary_key=True),
+                    sa.Column('collection_file_item_id', sa.Integer, nullable=False),
+                    )
+
+
+def downgrade():
+    op.drop_table('transform_upgrade_1_0_to_1_1_watermark')
@@ -0,0 +1,29 @@
+"""Memo of compiled releases, keyed by the data that was compiled
+
+Revision ID: 9e4c1d7b3a62
+Revises: 7f3a9b5d2c18
+Create Date: 2026-10-18 18:47:10.215387
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9e4c1d7b3a62'
+down_revision = '7f3a9b5d2c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('compiled_release_memo',
+                    sa.Column('hash_md5', sa.Text, nullable=False, primary_key=True),
+                    sa.Column('data_id', sa.Integer,
+                              sa.ForeignKey('data.id', name='fk_compiled_release_memo_data_id'),
+                              nullable=False),
+                    sa.Index('compiled_release_memo_data_id_idx', 'data_id'),
+                    )
+
+
+def downgrade():
+    op.drop_table('compiled_release_memo')
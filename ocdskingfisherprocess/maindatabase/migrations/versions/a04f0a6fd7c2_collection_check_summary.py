@@ -0,0 +1,52 @@
+"""Summary of validation errors in each collection
+
+Revision ID: a04f0a6fd7c2
+Revises: 8162575e2763
+Create Date: 2026-10-18 11:02:09.118604
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import ARRAY
+
+# revision identifiers, used by Alembic.
+revision = 'a04f0a6fd7c2'
+down_revision = '8162575e2763'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_check_summary',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey('collection.id', name='fk_collection_check_summary_collection_id'),
+                              nullable=False),
+                    sa.Column('data_type', sa.Text, nullable=False),
+                    sa.Column('override_schema_version', sa.Text, nullable=False),
+                    sa.Column('type', sa.Text, nullable=False),
+                    sa.Column('field', sa.Text, nullable=False),
+                    sa.Column('count', sa.Integer, nullable=False),
+                    sa.Column('error_count', sa.Integer, nullable=False),
+                    sa.Column('sample_ids', ARRAY(sa.Integer), nullable=False),
+                    sa.UniqueConstraint('collection_id', 'data_type', 'override_schema_version', 'type', 'field',
+                                        name='unique_collection_check_summary_identifiers'),
+                    )
+
+    for obj_type in ('release', 'record'):
+        op.execute("""
+            INSERT INTO collection_check_summary
+                (collection_id, data_type, override_schema_version, type, field, count, error_count, sample_ids)
+            SELECT {0}.collection_id, '{0}', {0}_check_result.override_schema_version,
+                coalesce(e.type, ''), coalesce(e.field, ''),
+                count(DISTINCT {0}.id), count(*), (array_agg(DISTINCT {0}.id ORDER BY {0}.id))[1:10]
+            FROM {0}_check_validation_error AS e
+            JOIN {0}_check_result ON {0}_check_result.id = e.{0}_check_id
+            JOIN {0} ON {0}.id = {0}_check_result.{0}_id
+            GROUP BY {0}.collection_id, {0}_check_result.override_schema_version,
+                coalesce(e.type, ''), coalesce(e.field, '')
+        """.format(obj_type))
+
+
+def downgrade():
+    op.drop_table('collection_check_summary')
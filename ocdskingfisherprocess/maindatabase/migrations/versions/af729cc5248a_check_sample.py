@@ -0,0 +1,79 @@
+"""Sampling for checks
+
+Revision ID: af729cc5248a
+Revises: 3b7e0c9d41a2
+Create Date: 2026-10-18 13:05:12.840931
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'af729cc5248a'
+down_revision = '3b7e0c9d41a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('collection', sa.Column('check_sample_rate', sa.Float, nullable=True))
+    op.add_column('collection', sa.Column('check_sample_size', sa.Integer, nullable=True))
+
+    for obj_type in ('release', 'record'):
+        op.add_column(obj_type + '_check_result',
+                      sa.Column('sampled', sa.Boolean, nullable=False, server_default=sa.false()))
+
+        op.execute("""
+            CREATE OR REPLACE VIEW {0}_check AS
+            SELECT
+                {0}_check_result.id,
+                {0}_check_result.{0}_id,
+                {0}_check_result.override_schema_version,
+                check_output.data || jsonb_build_object('validation_errors', coalesce((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'type', e.type,
+                        'field', e.field,
+                        'description', e.description,
+                        'path', e.path,
+                        'value', e.value
+                    ) ORDER BY e.id)
+                    FROM {0}_check_validation_error AS e
+                    WHERE e.{0}_check_id = {0}_check_result.id
+                ), '[]'::jsonb)) AS cove_output,
+                {0}_check_result.check_level,
+                {0}_check_result.sampled
+            FROM {0}_check_result
+            JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+        """.format(obj_type))
+
+
+def downgrade():
+    for obj_type in ('release', 'record'):
+        # A column can't be removed from a view with CREATE OR REPLACE VIEW.
+        op.execute("DROP VIEW {0}_check".format(obj_type))
+        op.execute("""
+            CREATE VIEW {0}_check AS
+            SELECT
+                {0}_check_result.id,
+                {0}_check_result.{0}_id,
+                {0}_check_result.override_schema_version,
+                check_output.data || jsonb_build_object('validation_errors', coalesce((
+                    SELECT jsonb_agg(jsonb_build_object(
+                        'type', e.type,
+                        'field', e.field,
+                        'description', e.description,
+                        'path', e.path,
+                        'value', e.value
+                    ) ORDER BY e.id)
+                    FROM {0}_check_validation_error AS e
+                    WHERE e.{0}_check_id = {0}_check_result.id
+                ), '[]'::jsonb)) AS cove_output,
+                {0}_check_result.check_level
+            FROM {0}_check_result
+            JOIN check_output ON check_output.id = {0}_check_result.check_output_id
+        """.format(obj_type))
+
+        op.drop_column(obj_type + '_check_result', 'sampled')
+
+    op.drop_column('collection', 'check_sample_size')
+    op.drop_column('collection', 'check_sample_rate')
@@ -0,0 +1,33 @@
+"""Watermarks for compiling releases while the source collection is being stored
+
+Revision ID: c2d84f6a1e07
+Revises: e61b7a3c9f25
+Create Date: 2026-10-18 17:12:45.380291
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c2d84f6a1e07'
+down_revision = 'e61b7a3c9f25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('transform_compile_releases_watermark',
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey('collection.id',
+                                            name='fk_transform_compile_releases_watermark_collection_id'),
+                              nullable=False, primary_key=True),
+                    sa.Column('release_id', sa.Integer, nullable=False),
+                    sa.Column('record_id', sa.Integer, nullable=False),
+                    sa.Column('next_release_id', sa.Integer, nullable=True),
+                    sa.Column('next_record_id', sa.Integer, nullable=True),
+                    sa.Column('next_compiled_release_id', sa.Integer, nullable=True),
+                    )
+
+
+def downgrade():
+    op.drop_table('transform_compile_releases_watermark')
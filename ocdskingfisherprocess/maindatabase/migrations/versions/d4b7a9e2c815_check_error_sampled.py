@@ -0,0 +1,26 @@
+"""Mark check errors in a sample
+
+Revision ID: d4b7a9e2c815
+Revises: 8a2f4c6e1b93
+Create Date: 2026-10-18 23:12:48.301557
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd4b7a9e2c815'
+down_revision = '8a2f4c6e1b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for obj_type in ('release', 'record'):
+        op.add_column(obj_type + '_check_error',
+                      sa.Column('sampled', sa.Boolean, nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    for obj_type in ('release', 'record'):
+        op.drop_column(obj_type + '_check_error', 'sampled')
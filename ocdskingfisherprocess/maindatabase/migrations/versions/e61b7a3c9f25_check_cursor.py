@@ -0,0 +1,35 @@
+"""Cursor for each pass of the checks, so that timeboxed runs resume where they stopped
+
+Revision ID: e61b7a3c9f25
+Revises: 5d21c8e0f3b7
+Create Date: 2026-10-18 15:41:27.903116
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e61b7a3c9f25'
+down_revision = '5d21c8e0f3b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_check_cursor',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey('collection.id', name='fk_collection_check_cursor_collection_id'),
+                              nullable=False),
+                    sa.Column('data_type', sa.Text, nullable=False),
+                    sa.Column('override_schema_version', sa.Text, nullable=False),
+                    sa.Column('check_level', sa.Text, nullable=False),
+                    sa.Column('checker_version', sa.Text, nullable=False),
+                    sa.Column('last_id', sa.Integer, nullable=False),
+                    sa.UniqueConstraint('collection_id', 'data_type', 'override_schema_version', 'check_level',
+                                        'checker_version', name='unique_collection_check_cursor_identifiers'),
+                    )
+
+
+def downgrade():
+    op.drop_table('collection_check_cursor')
@@ -2,7 +2,8 @@ class CollectionModel:
 
     def __init__(self, database_id=None, source_id=None, data_version=None, sample=None, transform_type='',
                  transform_from_collection_id=None, check_data=None, check_older_data_with_schema_version_1_1=None,
-                 store_start_at=None, store_end_at=None, deleted_at=None):
+                 check_level=None, check_sample_rate=None, check_sample_size=None, store_start_at=None,
+                 store_end_at=None, deleted_at=None):
         self.database_id = database_id
         self.source_id = source_id
         self.data_version = data_version
@@ -11,6 +12,9 @@ class CollectionModel:
         self.transform_from_collection_id = transform_from_collection_id
         self.check_data = check_data
         self.check_older_data_with_schema_version_1_1 = check_older_data_with_schema_version_1_1
+        self.check_level = check_level
+        self.check_sample_rate = check_sample_rate
+        self.check_sample_size = check_sample_size
         self.store_start_at = store_start_at
         self.store_end_at = store_end_at
         self.deleted_at = deleted_at
@@ -1,21 +1,28 @@
 import json
 
-from ocdskingfisherprocess.checks import Checks
+from ocdskingfisherprocess.checks import Checks, get_check_worker
 
 
 class ProcessQueueMessage:
 
     def __init__(self, database):
         self.database = database
+        # One worker is used for every message, so that it keeps what it has cached.
+        self.check_worker = get_check_worker(database.config)
 
     def process(self, message_as_string, run_until_timestamp=None):
         message_as_data = json.loads(message_as_string)
         if message_as_data['type'] == 'collection-data-store-finished':
             collection = self.database.get_collection(message_as_data['collection_id'])
             if collection:
-                checks = Checks(self.database, collection, run_until_timestamp=run_until_timestamp)
+                checks = Checks(self.database, collection, run_until_timestamp=run_until_timestamp,
+                                check_worker=self.check_worker)
                 # Older messages might not have the extra data in, so we need to check for this.
                 if 'collection_file_item_id' in message_as_data and message_as_data['collection_file_item_id']:
                     checks.process_file_item_id(message_as_data['collection_file_item_id'])
                 else:
                     checks.process_all_files()
+
+    def close(self):
+        if self.check_worker:
+            self.check_worker.stop()
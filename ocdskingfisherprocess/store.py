@@ -1,6 +1,7 @@
 import json
 
 from ocdskingfisherprocess.database import DatabaseStore
+from ocdskingfisherprocess.transform import TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
 from ocdskingfisherprocess.util import FileToStore
 
 
@@ -29,22 +30,49 @@ class Store:
         self.collection_id = None
         self.collection = None
         self.database = database
+        self.upgrade_collection_id = None
+        self._upgrade_collection_id_looked_up = False
 
     def load_collection(self, collection_source, collection_data_version, collection_sample):
         self.collection_id = self.database.get_or_create_collection_id(
             collection_source,
             collection_data_version,
             collection_sample)
+        self.upgrade_collection_id = None
+        self._upgrade_collection_id_looked_up = False
 
     def set_collection(self, collection):
         self.collection = collection
         self.collection_id = collection.database_id
+        self.upgrade_collection_id = None
+        self._upgrade_collection_id_looked_up = False
 
     def is_collection_store_ended(self):
         if not self.collection:
             self.collection = self.database.get_collection(self.collection_id)
         return self.collection.store_end_at is not None
 
+    def get_upgrade_collection_id(self):
+        """Returns the ID of the collection that upgrades this collection, if the standard pipeline upgrades data as it
+        is stored and there is such a collection that isn't deleted."""
+        if not self.config.standard_pipeline_upgrade_on_write:
+            return None
+        # The result is kept even if there is no such collection, so that it is only looked up once.
+        if not self._upgrade_collection_id_looked_up:
+            if not self.collection:
+                self.collection = self.database.get_collection(self.collection_id)
+            upgrade_collection_id = self.database.get_collection_id(
+                self.collection.source_id,
+                self.collection.data_version,
+                self.collection.sample,
+                transform_from_collection_id=self.collection_id,
+                transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+            if upgrade_collection_id and self.database.get_collection(upgrade_collection_id).deleted_at:
+                upgrade_collection_id = None
+            self.upgrade_collection_id = upgrade_collection_id
+            self._upgrade_collection_id_looked_up = True
+        return self.upgrade_collection_id
+
     def add_collection_note(self, note):
         if isinstance(note, str):
             note = note.strip()
@@ -146,7 +174,7 @@ class Store:
 
         with DatabaseStore(database=self.database, collection_id=self.collection_id, file_name=filename, number=number,
                            url=url, before_db_transaction_ends_callback=before_db_transaction_ends_callback,
-                           warnings=warnings) as store:
+                           warnings=warnings, upgrade_collection_id=self.get_upgrade_collection_id()) as store:
 
             if data_type == 'release' or data_type == 'record' or data_type == 'compiled_release' or \
                             data_type == 'release_list' or data_type == 'record_list':
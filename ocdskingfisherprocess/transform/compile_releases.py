@@ -1,10 +1,52 @@
+import contextlib
 import datetime
+import itertools
+import logging
+import multiprocessing
 
 import ocdsmerge
+import pkg_resources
 import sqlalchemy as sa
 from ocdskit.util import is_linked_release
 
+from ocdskingfisherprocess.database import CollectionNoteBulkStore, CompiledReleaseBulkStore, DataBase
 from ocdskingfisherprocess.transform.base import BaseTransform
+from ocdskingfisherprocess.util import get_hash_md5_for_data
+
+# The number of ocids to claim from the queue at a time.
+COMPILE_BATCH_SIZE = 1000
+
+# Building a merger means loading the release schema and working out the merge rules, so one is built for each schema
+# and reused for every ocid.
+_mergers = {}
+_merge_settings = {}
+
+
+def _get_merger(schema):
+    if schema not in _mergers:
+        _mergers[schema] = ocdsmerge.Merger(schema=schema or None)
+    return _mergers[schema]
+
+
+def _get_merge_settings(schema):
+    """Returns a hash of everything other than the releases that a compiled release depends on: the version of
+    ocdsmerge and the merge rules that it uses. The rules are hashed rather than the schema's URL or path, because the
+    default schema is the latest release schema, and because a local schema can be edited without its path changing."""
+    if schema not in _merge_settings:
+        merger = _get_merger(schema)
+        _merge_settings[schema] = get_hash_md5_for_data({
+            'ocdsmerge': pkg_resources.get_distribution('ocdsmerge').version,
+            'merge_rules': sorted([list(path), sorted(rules)] for path, rules in merger.merge_rules.items()),
+            'rule_overrides': sorted([list(path), str(rule)] for path, rule in merger.rule_overrides.items()),
+        })
+    return _merge_settings[schema]
+
+
+def _process_partition_in_worker(config, destination_collection, run_until_timestamp, partition, partitions):
+    # Each worker process has its own connections to the database.
+    transform = CompileReleasesTransform(config, DataBase(config), destination_collection,
+                                         run_until_timestamp=run_until_timestamp)
+    return transform._process_partition(partition, partitions)
 
 
 class CompileReleasesTransform(BaseTransform):
@@ -18,8 +60,8 @@ class CompileReleasesTransform(BaseTransform):
         if self.destination_collection.deleted_at:
             return
 
-        # This transform can only run when the source collection is fully stored!
-        if not self.source_collection.store_end_at:
+        # This transform can only run when the source collection is fully stored, unless compiling while storing.
+        if not self.source_collection.store_end_at and not self.config.compile_releases_while_storing:
             return
 
         # Have we already marked this transform as finished?
@@ -27,80 +69,184 @@ class CompileReleasesTransform(BaseTransform):
             return
 
         # Do the work ...
-        for ocid in self._get_ocids():
-            self._process_ocid(ocid)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
+        finished = self._process_windows()
+
+        # Early return?
+        if not finished:
+            return
 
         # Mark Transform as finished
         self.database.mark_collection_store_done(self.destination_collection.database_id)
 
-    def _get_ocids(self):
-        ''' Gets the ocids for this collection that have not been transformed'''
-        ocids = set()
-
-        # get ocids from releases
-        with self.database.get_engine().begin() as engine:
-            query = engine.execute(
-                sa.text(
-                    " SELECT r.ocid FROM release AS r" +
-                    " LEFT JOIN compiled_release AS cr ON " +
-                    " cr.ocid = r.ocid and cr.collection_id = :destination_collection_id" +
-                    " WHERE r.collection_id = :collection_id and cr.ocid is NULL" +
-                    " GROUP BY r.ocid "
-                ),
-                collection_id=self.source_collection.database_id,
-                destination_collection_id=self.destination_collection.database_id
-            )
-
-            ocids.update(row['ocid'] for row in query)
-
-        # get ocids from records
-        with self.database.get_engine().begin() as engine:
-            query = engine.execute(
-                sa.text(
-                    " SELECT r.ocid FROM record AS r" +
-                    " LEFT JOIN compiled_release AS cr ON " +
-                    " cr.ocid = r.ocid and cr.collection_id = :destination_collection_id" +
-                    " WHERE r.collection_id = :collection_id and cr.ocid is NULL" +
-                    " GROUP BY r.ocid "
-                ),
-                collection_id=self.source_collection.database_id,
-                destination_collection_id=self.destination_collection.database_id
-            )
+    def _process_windows(self):
+        ''' Compiles the ocids with releases or records that were stored since the last time, a window at a time,
+        replacing their old compiled releases. Returns whether the source collection had been fully stored and all of
+        it has been compiled.
+
+        When a window is started, its ocids are put in a queue, so that later runs can continue where this one stopped
+        without looking through the source collection again.'''
+        # If the source collection has been fully stored, the next window will cover the rest of it.
+        source_store_ended = bool(self.source_collection.store_end_at)
+
+        while True:
+            window = self.database.get_compile_releases_window(self.destination_collection.database_id)
+            if not window:
+                window = self.database.start_compile_releases_window(self.destination_collection.database_id,
+                                                                     self.source_collection.database_id)
+                if window['next_release_id'] == window['release_id'] \
+                        and window['next_record_id'] == window['record_id']:
+                    # Nothing new has been stored.
+                    self.database.end_compile_releases_window(self.destination_collection.database_id)
+                    return source_store_ended
+
+            if not self._process_window():
+                return False
+            self.database.end_compile_releases_window(self.destination_collection.database_id)
 
-            ocids.update(row['ocid'] for row in query)
-
-        # done
-        return ocids
-
-    def _process_ocid(self, ocid):
+            # Early return?
+            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+                return False
 
-        # Load Records
-        records = []
-        with self.database.get_engine().begin() as engine:
-            query = engine.execute(sa.text(
-                " SELECT record.* FROM record " +
-                " WHERE record.collection_id = :collection_id AND record.ocid = :ocid "
-            ), collection_id=self.source_collection.database_id, ocid=ocid)
+    def _process_window(self):
+        ''' Compiles the ocids in the queue. Returns whether the queue is empty.'''
+        if self.config.compile_releases_workers > 1:
+            finished = self._process_partitions_in_workers(self.config.compile_releases_workers)
+        else:
+            finished = self._process_partition()
+
+        if not finished:
+            return False
+
+        # Another run might still be compiling ocids that it claimed.
+        with self.database.get_engine().begin() as connection:
+            return not connection.execute(sa.text(
+                " SELECT FROM transform_compile_releases_queue WHERE collection_id = :collection_id LIMIT 1"
+            ), collection_id=self.destination_collection.database_id).rowcount
+
+    def _process_partitions_in_workers(self, partitions):
+        ''' Compiles the ocids in a pool of worker processes. Each ocid is in one partition, so no two workers compile
+        the same ocid. Returns whether every partition finished.'''
+        # spawn, not fork, so that the worker processes don't share this process's connections to the database, or
+        # copy the locks of other threads, like those of transform-collections.
+        with multiprocessing.get_context('spawn').Pool(partitions) as pool:
+            finished = pool.starmap(_process_partition_in_worker, [
+                (self.config, self.destination_collection, self.run_until_timestamp, partition, partitions)
+                for partition in range(partitions)
+            ])
+
+        return all(finished)
+
+    def _process_partition(self, partition=0, partitions=1):
+        ''' Compiles the ocids in one partition of the queue, or all ocids if there is one partition, a batch at a
+        time. Returns whether the partition was emptied before run_until_timestamp.'''
+        logger = logging.getLogger('ocdskingfisher.transform.compile-releases')
+        count = 0
+
+        while True:
+            # The claimed ocids are locked until they are removed from the queue, or the transaction is rolled back if
+            # anything goes wrong. Other runs skip them.
+            with self.database.get_engine().begin() as connection:
+                ocids = self._claim_ocids(connection, partition, partitions)
+                if not ocids:
+                    break
+
+                done = []
+                with contextlib.closing(self._get_rows(ocids)) as rows, \
+                        CompiledReleaseBulkStore(self.database, self.destination_collection.database_id,
+                                                 replace=True) as self.bulk_store, \
+                        CollectionNoteBulkStore(self.database,
+                                                self.destination_collection.database_id) as self.note_store:
+                    for ocid, rows_for_ocid in itertools.groupby(rows, key=lambda row: row['ocid']):
+                        self._process_ocid(ocid, list(rows_for_ocid))
+                        done.append(ocid)
+                        # Early return?
+                        if self.run_until_timestamp and \
+                                self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+                            break
+                    else:
+                        # Any ocids without data have nothing to compile.
+                        done = ocids
+
+                connection.execute(sa.text(
+                    " DELETE FROM transform_compile_releases_queue" +
+                    " WHERE collection_id = :collection_id AND ocid IN :ocids "
+                ), collection_id=self.destination_collection.database_id, ocids=tuple(done))
+                count += len(done)
 
-            records = [self.database.get_data(row['data_id']) for row in query]
+            # Early return?
+            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
+                logger.info('Compiled {} ocids in partition {} of {} of collection {} before stopping'.format(
+                    count, partition + 1, partitions, self.destination_collection.database_id))
+                return False
+
+        logger.info('Compiled {} ocids in partition {} of {} of collection {}'.format(
+            count, partition + 1, partitions, self.destination_collection.database_id))
+        return True
+
+    def _claim_ocids(self, connection, partition, partitions):
+        sql = """
+            SELECT ocid FROM transform_compile_releases_queue
+            WHERE collection_id = :collection_id
+        """
+        if partitions > 1:
+            # The sign bit is masked, so that the remainder isn't negative.
+            sql += """
+                AND mod(hashtext(ocid) & 2147483647, :partitions) = :partition
+            """
+        sql += """
+            ORDER BY ocid
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        """
+        return [row['ocid'] for row in connection.execute(sa.text(sql), {
+            'collection_id': self.destination_collection.database_id,
+            'partition': partition,
+            'partitions': partitions,
+            'limit': COMPILE_BATCH_SIZE,
+        })]
+
+    def _get_rows(self, ocids):
+        ''' Gets the records and releases for the given ocids in the source collection, ordered by ocid with records
+        first. The rows are streamed, so only one ocid's data is in memory at a time.'''
+        sql, data = self._get_rows_query(ocids)
+        return self.database.stream_rows(sql, data)
+
+    def _get_rows_query(self, ocids):
+        sql = """
+            SELECT 'record' AS type, record.ocid, record.id, data.hash_md5, data.data
+            FROM record
+            JOIN data ON data.id = record.data_id
+            WHERE record.collection_id = :collection_id AND record.ocid IN :ocids
+        """
+        sql += " UNION ALL " + sql.replace('record', 'release')
+        sql += " ORDER BY ocid, type, id "
+
+        return sql, {
+            'collection_id': self.source_collection.database_id,
+            'ocids': tuple(ocids),
+        }
+
+    def _process_ocid(self, ocid, rows):
+
+        # Records
+        records = [row for row in rows if row['type'] == 'record']
 
         # Decide what to do .....
         if len(records) > 1:
 
             warning = 'There are multiple records for this OCID! ' + \
                     'The record to pass through was selected arbitrarily.'
-            self._process_record(ocid, records[0], warnings=[warning])
+            self._process_record(ocid, records[0]['data'], warnings=[warning])
 
         elif len(records) == 1:
 
-            self._process_record(ocid, records[0])
+            self._process_record(ocid, records[0]['data'])
 
         else:
 
-            self._process_releases(ocid)
+            releases = [row for row in rows if row['type'] == 'release']
+            self._process_releases(ocid, [row['data'] for row in releases],
+                                   data_hashes=[row['hash_md5'] for row in releases])
 
     def _process_record(self, ocid, record, warnings=None):
 
@@ -122,7 +268,10 @@ class CompileReleasesTransform(BaseTransform):
                 warnings.append('This OCID had some releases without a date element. ' +
                                 'We have compiled all other releases.')
 
-            self._compile_releases_by_ocdsmerge(ocid, releases_with_date, warnings=warnings)
+            self._compile_releases_by_ocdsmerge(
+                ocid, releases_with_date, warnings=warnings,
+                data_hashes=[get_hash_md5_for_data(release) for release in releases_with_date]
+            )
             return
 
         # Whatever happens now, users will appreciate a warning about the bad data
@@ -156,24 +305,13 @@ class CompileReleasesTransform(BaseTransform):
 
         else:
             # We can't process this ocid. Warn of that.
-            self.database.add_collection_note(
-                self.destination_collection.database_id,
+            self.note_store.add(
                 'OCID ' + ocid + ' could not be compiled because at least one release in the releases array is a ' +
                 'linked release or there are no releases with dates, ' +
                 'and the record has neither a compileRelease nor a release with a tag of "compiled".'
             )
 
-    def _process_releases(self, ocid):
-
-        releases = []
-
-        with self.database.get_engine().begin() as engine:
-            query = engine.execute(sa.text(
-                " SELECT release.* FROM release " +
-                " WHERE release.collection_id = :collection_id AND release.ocid = :ocid "
-            ), collection_id=self.source_collection.database_id, ocid=ocid)
-
-            releases = [self.database.get_data(row['data_id']) for row in query]
+    def _process_releases(self, ocid, releases, data_hashes):
 
         # Are any releases already compiled? https://github.com/open-contracting/kingfisher-process/issues/147
         releases_compiled = \
@@ -199,11 +337,13 @@ class CompileReleasesTransform(BaseTransform):
                     warnings.append('This OCID had some releases without a date element. ' +
                                     'We have compiled all other releases.')
 
-                self._compile_releases_by_ocdsmerge(ocid, releases_with_date, warnings=warnings)
+                self._compile_releases_by_ocdsmerge(
+                    ocid, releases_with_date, warnings=warnings,
+                    data_hashes=[data_hash for release, data_hash in zip(releases, data_hashes) if 'date' in release]
+                )
             else:
                 # We can't process this ocid. Warn of that.
-                self.database.add_collection_note(
-                    self.destination_collection.database_id,
+                self.note_store.add(
                     'OCID ' + ocid + ' could not be compiled because there are no releases with dates ' +
                     'nor a release with a tag of "compiled".'
                 )
@@ -213,21 +353,37 @@ class CompileReleasesTransform(BaseTransform):
         releases_without_date = [r for r in releases if 'date' not in r]
         return releases_with_date, releases_without_date
 
-    def _compile_releases_by_ocdsmerge(self, ocid, releases, warnings=None):
+    def _compile_releases_by_ocdsmerge(self, ocid, releases, warnings=None, data_hashes=None):
+        memo_key = None
+        if data_hashes and all(data_hashes):
+            # If the same releases were compiled before, in any collection, with the same settings, reuse the result.
+            # Releases with the same date are merged in the order given, so in that case the order is part of the key.
+            dates = [str(release['date']) for release in releases]
+            memo_key = get_hash_md5_for_data({
+                'data': sorted(data_hashes) if len(set(dates)) == len(dates) else data_hashes,
+                'settings': _get_merge_settings(self.config.compile_releases_schema),
+            })
+            data_id = self.database.get_compiled_release_memo(memo_key)
+            if data_id:
+                self.bulk_store.add(ocid, None, warnings=warnings, data_id=data_id)
+                return
+
         try:
-            merger = ocdsmerge.Merger()
+            merger = _get_merger(self.config.compile_releases_schema)
             out = merger.create_compiled_release(releases)
-            self._store_result(ocid, out, warnings=warnings)
+            self._store_result(ocid, out, warnings=warnings, memo_key=memo_key)
         except ocdsmerge.exceptions.OCDSMergeError as error:
-            self.database.add_collection_note(
-                self.destination_collection.database_id,
+            self.note_store.add(
                 'OCID ' + ocid + ' could not be compiled because merge library threw an error: '
                 + error.__class__.__name__ + ' ' + str(error)
             )
 
-    def _store_result(self, ocid, data, warnings=None):
+    def _store_result(self, ocid, data, warnings=None, memo_key=None):
+
+        if not isinstance(data, dict):
+            raise Exception("Can not process data as JSON is not an object")
 
         # In the occurrence of a race condition where two concurrent transforms have run the same ocid
-        # we rely on the fact that collection_id and filename are unique in the file_item table.
-        # Therefore this will error with a violation of unique key constraint and not cause duplicate entries.
-        self.store.store_file_item(ocid+'.json', '', 'compiled_release', data, 1, warnings=warnings)
+        # we rely on the fact that collection_id and filename are unique in the collection_file table.
+        # The bulk store skips ocids that already have a file, so this will not cause duplicate entries.
+        self.bulk_store.add(ocid, data, warnings=warnings, memo_key=memo_key)
@@ -1,11 +1,24 @@
 import datetime
+import multiprocessing
 
 import sqlalchemy as sa
 from ocdskit.upgrade import upgrade_10_11
 
-from ocdskingfisherprocess.database import DatabaseStore
+from ocdskingfisherprocess.database import DataBase, UpgradeBulkStore
 from ocdskingfisherprocess.transform.base import BaseTransform
 
+UPGRADE_BATCH_SIZE = 1000
+# The number of upgraded data ids to remember in a run. The memo is cleared when it is full.
+UPGRADE_MEMO_SIZE = 100000
+
+
+def _process_partition_in_worker(config, destination_collection, run_until_timestamp, partition, partitions,
+                                 after_collection_file_item_id):
+    # Each worker process has its own connections to the database.
+    transform = Upgrade10To11Transform(config, DataBase(config), destination_collection,
+                                       run_until_timestamp=run_until_timestamp)
+    return transform._process_partition(partition, partitions, after_collection_file_item_id)
+
 
 class Upgrade10To11Transform(BaseTransform):
 
@@ -22,135 +35,175 @@ class Upgrade10To11Transform(BaseTransform):
         if self.destination_collection.store_end_at:
             return
 
+        # While the source collection is being stored, only the collection file items stored since the last run that
+        # finished are looked at. Items can be committed out of order, so once the source collection has ended, every
+        # item is looked at once more.
+        if self.source_collection.store_end_at:
+            after_collection_file_item_id = 0
+        else:
+            after_collection_file_item_id = \
+                self.database.get_upgrade_1_0_to_1_1_watermark(self.destination_collection.database_id)
+        last_collection_file_item_id = \
+            self.database.get_max_collection_file_item_id(self.source_collection.database_id)
+
         # Do the work ...
-        for file_model in self.database.get_all_files_in_collection(self.source_collection.database_id):
-            self.process_file(file_model)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
+        if self.config.upgrade_1_0_to_1_1_workers > 1:
+            finished = self._process_partitions_in_workers(self.config.upgrade_1_0_to_1_1_workers,
+                                                           after_collection_file_item_id)
+        else:
+            finished = self._process_partition(after_collection_file_item_id=after_collection_file_item_id)
+
+        if not finished:
+            return
+
+        self.database.set_upgrade_1_0_to_1_1_watermark(self.destination_collection.database_id,
+                                                       last_collection_file_item_id)
 
         # We maybe mark the transform as finished here
         # There is a race condition we have to be careful off
         # * Collection starts being downloaded, 100 files downloaded and saved
         # * Transform starts
-        # * Transform loads list of 100 files into memory
-        # * Transform takes a while to process all 100 files
+        # * Transform finds the releases and records that aren't upgraded, a batch at a time
+        # * Transform takes a while to process all the batches
         # * In that time, 10 final files are downloaded and saved and source collection is marked as ended
-        # * Now we can't mark the destination collection as closed because we haven't processed the 10 final files!
+        # * Now we can't mark the destination collection as closed unless we have processed the 10 final files!
         # Fortunately, because this check is "if self.source_collection.store_end_at" and
         #   because "self.source_collection" is loaded into memory right at start, this race condition can't occur.
         # But leaving comment as warning to others that order of loading things into memory is important
         if self.source_collection.store_end_at:
             self.database.mark_collection_store_done(self.destination_collection.database_id)
 
-    def process_file(self, file_model):
-        for file_item_model in self.database.get_all_files_items_in_file(file_model):
-            self.process_file_item(file_model, file_item_model)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
-
-    def process_file_item(self, file_model, file_item_model):
-        with self.database.get_engine().begin() as connection:
-            release_rows = connection.execute(
-                self.database.release_table.select().where(
-                    self.database.release_table.c.collection_file_item_id == file_item_model.database_id)
-            )
+    def _process_partitions_in_workers(self, partitions, after_collection_file_item_id=0):
+        ''' Upgrades in a pool of worker processes. Each collection file is in one partition, so no two workers upgrade
+        the same data. Returns whether every partition finished.'''
+        # spawn, not fork, so that the worker processes don't share this process's connections to the database, or
+        # copy the locks of other threads, like those of transform-collections.
+        with multiprocessing.get_context('spawn').Pool(partitions) as pool:
+            finished = pool.starmap(_process_partition_in_worker, [
+                (self.config, self.destination_collection, self.run_until_timestamp, partition, partitions,
+                 after_collection_file_item_id)
+                for partition in range(partitions)
+            ])
+
+        return all(finished)
+
+    def _process_partition(self, partition=0, partitions=1, after_collection_file_item_id=0):
+        ''' Upgrades the releases and records in one partition of the collection files, or in all collection files if
+        there is one partition. Returns whether the partition was finished before run_until_timestamp.'''
+        for obj_type in ('release', 'record'):
+            if not self._process_type(obj_type, partition, partitions, after_collection_file_item_id):
+                return False
+        return True
+
+    def _process_type(self, obj_type, partition, partitions, after_collection_file_item_id):
+        ''' Upgrades the releases or records that haven't been upgraded, a batch at a time. Returns whether all were
+        upgraded before run_until_timestamp.'''
+        after_id = 0
+
+        # The same package data is shared by every release or record in a package, and the same data can be in many
+        # packages, so remember the upgraded ids instead of upgrading and looking them up again. The memos map source
+        # ids to destination ids. Whether data is upgraded depends on the version of its package, so the data memo is
+        # also keyed by the version.
+        self._package_data_ids = {}
+        self._data_ids = {}
+
+        while True:
+            rows = self._get_rows(obj_type, after_id, partition, partitions, after_collection_file_item_id)
+            if not rows:
+                return True
+
+            with UpgradeBulkStore(self.database, self.destination_collection.database_id, obj_type,
+                                  batch_size=UPGRADE_BATCH_SIZE) as bulk_store:
+                for row in rows:
+                    self._process_row(bulk_store, obj_type, row)
+            after_id = rows[-1]['id']
+
+            if len(self._data_ids) > UPGRADE_MEMO_SIZE:
+                self._data_ids = {}
+            for row in rows:
+                if row['id'] in bulk_store.stored_ids:
+                    data_id, package_data_id = bulk_store.stored_ids[row['id']]
+                    self._data_ids[(row['data_id'], row['version'])] = data_id
+                    self._package_data_ids[row['package_data_id']] = package_data_id
 
-            release_ids = [x['id'] for x in release_rows]
-
-        for release_id in release_ids:
-            if not self.has_release_id_been_done(release_id):
-                self.process_release_id(file_model, file_item_model, release_id)
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
-
-        del release_rows
+                return False
 
-        with self.database.get_engine().begin() as connection:
-            record_rows = connection.execute(
-                self.database.record_table.select().where(
-                    self.database.record_table.c.collection_file_item_id == file_item_model.database_id)
-            )
-
-            record_ids = [x['id'] for x in record_rows]
-
-        for record_id in record_ids:
-            if not self.has_record_id_been_done(record_id):
-                self.process_record_id(file_model, file_item_model, record_id)
-            # Early return?
-            if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
-                return
+    def _get_rows(self, obj_type, after_id, partition=0, partitions=1, after_collection_file_item_id=0):
+        ''' Gets a batch of the releases or records in the source collection that haven't been upgraded, with their
+        data and the collection file item they are in.
 
-    def process_release_id(self, file_model, file_item_model, release_id):
+        Packages that are already 1.1 aren't changed by the upgrade, so their data isn't fetched.'''
+        sql, data = self._get_rows_query(obj_type, after_id, partition, partitions, after_collection_file_item_id)
         with self.database.get_engine().begin() as connection:
-            s = sa.sql.select([self.database.release_table]) \
-                .where(self.database.release_table.c.id == release_id)
-            result = connection.execute(s)
-            release_row = result.fetchone()
-
-        package = self.database.get_package_data(release_row.package_data_id)
-        package['releases'] = [self.database.get_data(release_row.data_id)]
-        package = upgrade_10_11(package)
-
-        def add_status(database, connection):
-            connection.execute(database.transform_upgrade_1_0_to_1_1_status_release_table.insert(), {
-                'source_release_id': release_row.id,
-            })
-
-        package_data = {}
-        for key, value in package.items():
-            if key != 'releases':
-                package_data[key] = value
-
-        with DatabaseStore(database=self.database, collection_id=self.destination_collection.database_id,
-                           file_name=file_model.filename, number=file_item_model.number,
-                           url=file_model.url, before_db_transaction_ends_callback=add_status,
-                           allow_existing_collection_file_item_table_row=True) as store:
-
-            store.insert_release(package['releases'][0], package_data)
+            return connection.execute(sa.text(sql), data).fetchall()
+
+    def _get_rows_query(self, obj_type, after_id, partition=0, partitions=1, after_collection_file_item_id=0):
+        sql = """
+            SELECT release.id, release.ocid, release.data_id, release.package_data_id,
+                collection_file.filename, collection_file.url, collection_file_item.number,
+                package_data.data ->> 'version' AS version,
+                CASE WHEN package_data.data ->> 'version' = '1.1' THEN NULL ELSE data.data END AS data,
+                CASE WHEN package_data.data ->> 'version' = '1.1' THEN NULL ELSE package_data.data END AS package_data
+                {columns}
+            FROM release
+            JOIN collection_file_item ON collection_file_item.id = release.collection_file_item_id
+            JOIN collection_file ON collection_file.id = collection_file_item.collection_file_id
+            JOIN data ON data.id = release.data_id
+            JOIN package_data ON package_data.id = release.package_data_id
+            WHERE release.collection_id = :collection_id
+                AND release.id > :after_id
+                AND collection_file_item.id > :after_collection_file_item_id
+                AND NOT EXISTS (
+                    SELECT FROM transform_upgrade_1_0_to_1_1_status_release
+                    WHERE source_release_id = release.id
+                )
+                {partition}
+            ORDER BY release.id
+            LIMIT :limit
+        """.replace('release', obj_type)
+        # Only releases have a release_id column.
+        sql = sql.format(
+            columns=', release.release_id' if obj_type == 'release' else '',
+            partition='AND mod(collection_file.id, :partitions) = :partition' if partitions > 1 else '',
+        )
+
+        return sql, {
+            'collection_id': self.source_collection.database_id,
+            'after_id': after_id,
+            'after_collection_file_item_id': after_collection_file_item_id,
+            'partition': partition,
+            'partitions': partitions,
+            'limit': UPGRADE_BATCH_SIZE,
+        }
+
+    def _process_row(self, bulk_store, obj_type, row):
+        release_id = row['release_id'] if obj_type == 'release' else ''
+
+        if row['version'] == '1.1':
+            # Store the destination row with the same data as the source row.
+            bulk_store.add(row['id'], row['filename'], row['url'], row['number'], None, None,
+                           data_id=row['data_id'], package_data_id=row['package_data_id'], ocid=row['ocid'],
+                           release_id=release_id)
+            return
 
-    def process_record_id(self, file_model, file_item_model, record_id):
-        with self.database.get_engine().begin() as connection:
-            s = sa.sql.select([self.database.record_table]) \
-                .where(self.database.record_table.c.id == record_id)
-            result = connection.execute(s)
-            record_row = result.fetchone()
+        data_id = self._data_ids.get((row['data_id'], row['version']))
+        package_data_id = self._package_data_ids.get(row['package_data_id'])
+        if data_id and package_data_id:
+            bulk_store.add(row['id'], row['filename'], row['url'], row['number'], None, None,
+                           data_id=data_id, package_data_id=package_data_id, ocid=row['ocid'], release_id=release_id)
+            return
 
-        package = self.database.get_package_data(record_row.package_data_id)
-        package['records'] = [self.database.get_data(record_row.data_id)]
+        package = row['package_data']
+        package[obj_type + 's'] = [row['data']]
         package = upgrade_10_11(package)
 
-        def add_status(database, connection):
-            connection.execute(database.transform_upgrade_1_0_to_1_1_status_record_table.insert(), {
-                'source_record_id': record_row.id,
-            })
-
         package_data = {}
         for key, value in package.items():
-            if key != 'records':
+            if key != obj_type + 's':
                 package_data[key] = value
 
-        with DatabaseStore(database=self.database, collection_id=self.destination_collection.database_id,
-                           file_name=file_model.filename, number=file_item_model.number,
-                           url=file_model.url, before_db_transaction_ends_callback=add_status,
-                           allow_existing_collection_file_item_table_row=True) as store:
-
-            store.insert_record(package['records'][0], package_data)
-
-    def has_release_id_been_done(self, release_id):
-        with self.database.get_engine().begin() as connection:
-            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_release_table]) \
-                .where(
-                    self.database.transform_upgrade_1_0_to_1_1_status_release_table.c.source_release_id == release_id
-                )
-            result = connection.execute(s)
-            return result.rowcount == 1
-
-    def has_record_id_been_done(self, record_id):
-        with self.database.get_engine().begin() as connection:
-            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_record_table]) \
-                .where(self.database.transform_upgrade_1_0_to_1_1_status_record_table.c.source_record_id == record_id)
-            result = connection.execute(s)
-            return result.rowcount == 1
+        bulk_store.add(row['id'], row['filename'], row['url'], row['number'], package[obj_type + 's'][0],
+                       package_data, data_id=data_id, package_data_id=package_data_id, ocid=row['ocid'],
+                       release_id=release_id)
@@ -1,3 +1,5 @@
+import hashlib
+
 from ocdskingfisherprocess.config import Config
 from ocdskingfisherprocess.database import DataBase
 from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
@@ -5,6 +7,11 @@ from ocdskingfisherprocess.signals.signals import setup_signals
 from ocdskingfisherprocess.web.app import create_app
 
 
+def get_sample_hash(row_id):
+    """Returns the hash of a release or record id that decides whether it is in a check sample, between 0 and 1."""
+    return int(hashlib.md5(str(row_id).encode()).hexdigest()[:8], 16) / 2 ** 32
+
+
 def _reset_signals():
     KINGFISHER_SIGNALS.signal('new_collection_created')._clear_state()
 
@@ -1,11 +1,14 @@
 import datetime
 import os
+import time
 
 import sqlalchemy as sa
+from libcoveocds.api import APIException
 
-from ocdskingfisherprocess.checks import Checks
+from ocdskingfisherprocess.checks import CHECK_LEVEL_FULL, CHECK_LEVEL_SCHEMA, Checks, get_check_worker
+from ocdskingfisherprocess.database import PENDING_WORK_CHECK
 from ocdskingfisherprocess.store import Store
-from tests.base import BaseDataBaseTest
+from tests.base import BaseDataBaseTest, get_sample_hash
 
 
 class TestAllChecksOff(BaseDataBaseTest):
@@ -837,3 +840,575 @@ class TestCheck11NotSelected(BaseDataBaseTest):
         assert \
             len([res for res in self.database.get_releases_to_check(collection_id, override_schema_version='1.2')]) \
             == 6
+
+
+class TestCheckOutputStorage(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Call Checks
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+            # The output of CoVE is shared between the checks where it is the same
+            s = sa.sql.select([self.database.check_output_table])
+            result = connection.execute(s)
+            assert 1 <= result.rowcount <= 2
+            for row in result:
+                assert 'validation_errors' not in row['data']
+
+            # The view puts the validation errors back
+            s = sa.sql.select([self.database.release_check_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            validation_errors_count = 0
+            for row in result:
+                assert isinstance(row['cove_output']['validation_errors'], list)
+                assert 'file_type' in row['cove_output']
+                validation_errors_count += len(row['cove_output']['validation_errors'])
+
+            s = sa.sql.select([self.database.release_check_validation_error_table])
+            result = connection.execute(s)
+            assert validation_errors_count == result.rowcount
+
+            # The summary is kept up to date as each check is stored
+            s = sa.sql.select([self.database.collection_check_summary_table])
+            result = connection.execute(s)
+            summary_error_count = 0
+            for row in result:
+                assert collection_id == row['collection_id']
+                assert 'release' == row['data_type']
+                assert 1 <= row['count'] <= 2
+                assert row['count'] == len(row['sample_ids'])
+                summary_error_count += row['error_count']
+            assert validation_errors_count == summary_error_count
+
+        # Delete
+        self.database.mark_collection_deleted_at(collection_id)
+        self.database.delete_collection(collection_id)
+        self.database.delete_orphan_data()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_validation_error_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.collection_check_summary_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.check_output_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+
+def _slow_handle_package(check_level, package):
+    time.sleep(10)
+
+
+def _failing_handle_package(check_level, package):
+    raise APIException('The check failed')
+
+
+class TestCheckTimeout(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+        self.config.check_timeout_seconds = 1
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Call Checks, with a check that takes too long
+        checks = Checks(self.database, collection)
+        checks.check_worker.handle_package = _slow_handle_package
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            # Each release is recorded as an error, and the run moves on
+            s = sa.sql.select([self.database.release_check_error_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            for row in result:
+                assert 'Check timed out after 1 seconds' == row['error']
+
+
+class TestCheckWorkerIsShared(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        check_worker = get_check_worker(self.config)
+        try:
+            # The worker that is passed in is used for each run, and is left running
+            checks = Checks(self.database, collection, max_items=1, check_worker=check_worker)
+            checks.process_all_files()
+            assert 1 == checks.items_checked
+            pid = check_worker._process.pid
+
+            checks = Checks(self.database, collection, max_items=1, check_worker=check_worker)
+            checks.process_all_files()
+            assert 1 == checks.items_checked
+            assert pid == check_worker._process.pid
+        finally:
+            check_worker.stop()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+
+class TestCheckLevelSchema(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+        self.database.mark_collection_check_level(collection_id, CHECK_LEVEL_SCHEMA)
+
+        collection = self.database.get_collection(collection_id)
+        assert CHECK_LEVEL_SCHEMA == collection.check_level
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Call Checks
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            for row in result:
+                assert CHECK_LEVEL_SCHEMA == row['check_level']
+                # Only the validation errors are stored
+                assert ['validation_errors'] == list(row['cove_output'].keys())
+
+        # Nothing is left to check at this level
+        assert 0 == len(list(self.database.get_releases_to_check(collection_id, check_level=CHECK_LEVEL_SCHEMA)))
+
+        # The full checks can be run on demand
+        checks = Checks(self.database, collection, check_level=CHECK_LEVEL_FULL)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_table]) \
+                .where(self.database.release_check_table.c.check_level == CHECK_LEVEL_FULL)
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            for row in result:
+                assert 'file_type' in row['cove_output']
+
+    def test_release_with_wrong_type_of_nullable_field(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+        self.database.mark_collection_check_level(collection_id, CHECK_LEVEL_SCHEMA)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        data = {
+            'uri': 'http://example.com',
+            'publishedDate': '2020-01-01T00:00:00Z',
+            'publisher': {'name': 'Example'},
+            'version': '1.1',
+            'releases': [{
+                'ocid': 'ocds-213czf-1',
+                'id': '1',
+                'date': '2020-01-01T00:00:00Z',
+                'tag': ['tender'],
+                'initiationType': 'tender',
+                'tender': {'id': '1', 'title': 1},
+            }],
+        }
+        store.store_file_from_data("test.json", "http://example.com", "release_package", data)
+
+        # Call Checks
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        # The list of types is stored as a string
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_error_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.release_check_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+            validation_errors = result.fetchone()['cove_output']['validation_errors']
+            assert 'string, null' in [error['type'] for error in validation_errors]
+
+            s = sa.sql.select([self.database.collection_check_summary_table])
+            result = connection.execute(s)
+            assert 'string, null' in [row['type'] for row in result]
+
+
+class TestCheckSample(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            release_ids = sorted((row['id'] for row in connection.execute(s)), key=get_sample_hash)
+
+        # A sample size is converted to a rate
+        expected = sorted(release_id for release_id in release_ids if get_sample_hash(release_id) < 0.5)
+        assert expected == [row['id'] for row in self.database.get_releases_to_check(collection_id, sample_size=1)]
+
+        # Take a sample with only the release with the lower hash
+        sample_rate = (get_sample_hash(release_ids[0]) + get_sample_hash(release_ids[1])) / 2
+        self.database.mark_collection_check_sample(collection_id, sample_rate=sample_rate)
+        collection = self.database.get_collection(collection_id)
+
+        # Call Checks
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+            assert release_ids[0] == result.fetchone()['release_id']
+
+        # The same sample is taken each time
+        assert [] == list(self.database.get_releases_to_check(collection_id, sample_rate=sample_rate))
+
+        # The sample can be extended to the whole collection
+        self.database.mark_collection_check_sample(collection_id)
+        collection = self.database.get_collection(collection_id)
+
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            for row in result:
+                assert (row['release_id'] == release_ids[0]) == row['sampled']
+
+    def test_sample_size_is_converted_once(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        rows = self.database.get_releases_to_check(collection_id, sample_size=2, batch_size=1)
+        release_ids = [next(rows)['id']]
+
+        # The collection doubles in size while the rows are being read, but the rate stays at 1.
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+        release_ids.extend(row['id'] for row in rows)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            expected = sorted(row['id'] for row in connection.execute(s))
+
+        assert 4 == len(expected)
+        assert expected == release_ids
+
+    def test_error_is_sampled(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+        self.database.mark_collection_check_sample(collection_id, sample_rate=1)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Call Checks, with a check that fails
+        checks = Checks(self.database, collection)
+        checks.check_worker.handle_package = _failing_handle_package
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_error_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            for row in result:
+                assert row['sampled']
+
+
+class TestCheckerVersion(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+        self.config.checker_version = 'old'
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Call Checks
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+        # A new version of the checks checks the data again
+        self.config.checker_version = 'new'
+        assert 2 == len(list(self.database.get_releases_to_check(collection_id, checker_version='new')))
+
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+
+        assert 0 == len(list(self.database.get_releases_to_check(collection_id, checker_version='new')))
+
+        # The old results are kept
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_check_result_table])
+            result = connection.execute(s)
+            assert 4 == result.rowcount
+            assert ['new', 'new', 'old', 'old'] == sorted(row['checker_version'] for row in result)
+
+
+class TestCheckMaxItems(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Each call checks one release
+        for expected in (1, 2):
+            checks = Checks(self.database, collection, max_items=1)
+            checks.process_all_files()
+            assert 1 == checks.items_checked
+
+            with self.database.get_engine().begin() as connection:
+                s = sa.sql.select([self.database.release_check_result_table])
+                result = connection.execute(s)
+                assert expected == result.rowcount
+
+        # Nothing is left to check
+        checks = Checks(self.database, collection, max_items=1)
+        checks.process_all_files()
+        assert 0 == checks.items_checked
+
+    def test_releases_with_one_checks(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Each call checks one release, like the rounds of check-collections
+        checks = Checks(self.database, collection, max_items=1)
+        for expected in (1, 1, 0):
+            checks.process_all_files()
+            assert expected == checks.items_checked
+
+
+class TestCheckCursor(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def test_releases(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.mark_collection_check_data(collection_id, True)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]).order_by(self.database.release_table.c.id)
+            release_ids = [row['id'] for row in connection.execute(s)]
+
+        # The cursor is after the release that was checked
+        checks = Checks(self.database, collection, max_items=1)
+        checks.process_all_files()
+        assert release_ids[0] == self.database.get_check_cursor(collection_id, 'release', '', CHECK_LEVEL_FULL, '')
+
+        assert [collection_id] == [c.database_id for c in
+                                   self.database.get_collections_with_pending_work(PENDING_WORK_CHECK)]
+
+        # The next run continues from the cursor
+        checks = Checks(self.database, collection)
+        checks.process_all_files()
+        assert 1 == checks.items_checked
+        assert release_ids[1] == self.database.get_check_cursor(collection_id, 'release', '', CHECK_LEVEL_FULL, '')
+
+        assert [] == self.database.get_collections_with_pending_work(PENDING_WORK_CHECK)
+
+        # The cursors are cleared when the store ends, in case data was committed out of order
+        self.database.mark_collection_store_done(collection_id)
+        assert 0 == self.database.get_check_cursor(collection_id, 'release', '', CHECK_LEVEL_FULL, '')
+
+    def test_releases_streamed_in_batches(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Smaller batches than the number of rows
+        release_ids = [row['id'] for row in self.database.get_releases_to_check(collection_id, batch_size=1)]
+        assert 2 == len(release_ids)
+        assert sorted(release_ids) == release_ids
+
+        # As many rows as the batch size
+        assert release_ids == [row['id'] for row in self.database.get_releases_to_check(collection_id, batch_size=2)]
+
+        # Start after an id
+        assert release_ids[1:] == [row['id'] for row in
+                                   self.database.get_releases_to_check(collection_id, after_id=release_ids[0])]
@@ -0,0 +1,111 @@
+import datetime
+import os
+
+import sqlalchemy as sa
+
+from ocdskingfisherprocess.database import (PENDING_WORK_CHECK, PENDING_WORK_DELETE, PENDING_WORK_TRANSFORM,
+                                            PENDING_WORK_UPDATE_CACHES)
+from ocdskingfisherprocess.store import Store
+from ocdskingfisherprocess.transform import TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
+from tests.base import BaseDataBaseTest, get_sample_hash
+
+
+class TestPendingWork(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def _get_pending_collection_ids(self, work, checker_version=None):
+        return [collection.database_id for collection in
+                self.database.get_collections_with_pending_work(work, checker_version=checker_version)]
+
+    def test_check(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Checks are off
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+
+        self.database.mark_collection_check_data(collection_id, True)
+        assert [collection_id] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+
+        for release in self.database.get_releases_to_check(collection_id):
+            self.database.store_release_check(collection_id, release['id'], '', {'validation_errors': []},
+                                              checker_version='old')
+
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_CHECK, checker_version='old')
+        assert [collection_id] == self._get_pending_collection_ids(PENDING_WORK_CHECK, checker_version='new')
+
+        # Deleted collections aren't checked
+        self.database.mark_collection_deleted_at(collection_id)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_CHECK, checker_version='new')
+
+    def test_check_sample(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            release_ids = sorted((row['id'] for row in connection.execute(s)), key=get_sample_hash)
+
+        # Take a sample with only the release with the lower hash
+        sample_rate = (get_sample_hash(release_ids[0]) + get_sample_hash(release_ids[1])) / 2
+        self.database.mark_collection_check_data(collection_id, True)
+        self.database.mark_collection_check_sample(collection_id, sample_rate=sample_rate)
+        assert [collection_id] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+
+        # Once the sample is checked, there is no work, though the other release isn't checked
+        self.database.store_release_check(collection_id, release_ids[0], '', {'validation_errors': []},
+                                          sampled=True)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+
+        # The sample can be extended to the whole collection
+        self.database.mark_collection_check_sample(collection_id)
+        assert [collection_id] == self._get_pending_collection_ids(PENDING_WORK_CHECK)
+
+    def test_transform_update_caches_and_delete(self):
+
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        destination_collection_id = self.database.get_or_create_collection_id(
+            "test", datetime.datetime.now(), False,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+
+        assert [destination_collection_id] == self._get_pending_collection_ids(PENDING_WORK_TRANSFORM)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_UPDATE_CACHES)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_DELETE)
+
+        self.database.mark_collection_store_done(source_collection_id)
+        self.database.mark_collection_store_done(destination_collection_id)
+
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_TRANSFORM)
+        assert [source_collection_id, destination_collection_id] == \
+            self._get_pending_collection_ids(PENDING_WORK_UPDATE_CACHES)
+
+        self.database.update_collection_cached_columns(source_collection_id)
+        assert [destination_collection_id] == self._get_pending_collection_ids(PENDING_WORK_UPDATE_CACHES)
+
+        self.database.mark_collection_deleted_at(destination_collection_id)
+        assert [] == self._get_pending_collection_ids(PENDING_WORK_UPDATE_CACHES)
+        assert [destination_collection_id] == self._get_pending_collection_ids(PENDING_WORK_DELETE)
@@ -0,0 +1,143 @@
+import datetime
+
+import sqlalchemy as sa
+
+from ocdskingfisherprocess.checks import CHECK_LEVEL_FULL
+from ocdskingfisherprocess.database import PENDING_WORK_CHECK, CompiledReleaseBulkStore
+from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES, TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
+from ocdskingfisherprocess.transform.compile_releases import CompileReleasesTransform
+from ocdskingfisherprocess.transform.upgrade_1_0_to_1_1 import Upgrade10To11Transform
+from tests.base import BaseDataBaseTest
+
+COLLECTIONS = 20
+ROWS_PER_COLLECTION = 1000
+OCIDS_PER_COLLECTION = 100
+
+
+class TestQueryPlans(BaseDataBaseTest):
+    """Runs EXPLAIN on the queries that run most often, against enough data that the planner prefers an index if there
+    is one, and fails if any of them scans a whole release, record or compiled_release table, or doesn't use the index
+    that is meant for it."""
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = False
+
+    def setup_method(self, test_method):
+        super().setup_method(test_method)
+
+        self.collection_ids = [
+            self.database.get_or_create_collection_id("test", datetime.datetime(2020, 1, 1, 0, 0, i), False)
+            for i in range(COLLECTIONS)
+        ]
+
+        with self.database.get_engine().begin() as connection:
+            data_id = connection.execute(sa.sql.text("""
+                INSERT INTO data (hash_md5, data) VALUES ('synthetic', '{}') RETURNING id
+            """)).scalar()
+            package_data_id = connection.execute(sa.sql.text("""
+                INSERT INTO package_data (hash_md5, data) VALUES ('synthetic', '{}') RETURNING id
+            """)).scalar()
+
+            for collection_id in self.collection_ids:
+                collection_file_id = connection.execute(sa.sql.text("""
+                    INSERT INTO collection_file (collection_id, filename, url) VALUES (:collection_id, 'test.json', '')
+                    RETURNING id
+                """), {'collection_id': collection_id}).scalar()
+                collection_file_item_id = connection.execute(sa.sql.text("""
+                    INSERT INTO collection_file_item (collection_file_id, number) VALUES (:collection_file_id, 0)
+                    RETURNING id
+                """), {'collection_file_id': collection_file_id}).scalar()
+
+                params = {
+                    'collection_id': collection_id,
+                    'collection_file_item_id': collection_file_item_id,
+                    'data_id': data_id,
+                    'package_data_id': package_data_id,
+                    'rows': ROWS_PER_COLLECTION,
+                    'ocids': OCIDS_PER_COLLECTION,
+                }
+                connection.execute(sa.sql.text("""
+                    INSERT INTO release
+                        (collection_id, collection_file_item_id, release_id, ocid, data_id, package_data_id)
+                    SELECT :collection_id, :collection_file_item_id, i::text, 'ocds-213czf-' || i % :ocids,
+                        :data_id, :package_data_id
+                    FROM generate_series(1, :rows) AS i
+                """), params)
+                connection.execute(sa.sql.text("""
+                    INSERT INTO record (collection_id, collection_file_item_id, ocid, data_id, package_data_id)
+                    SELECT :collection_id, :collection_file_item_id, 'ocds-213czf-' || i, :data_id, :package_data_id
+                    FROM generate_series(1, :rows) AS i
+                """), params)
+                connection.execute(sa.sql.text("""
+                    INSERT INTO compiled_release (collection_id, collection_file_item_id, ocid, data_id)
+                    SELECT :collection_id, :collection_file_item_id, 'ocds-213czf-' || i, :data_id
+                    FROM generate_series(1, :rows) AS i
+                """), params)
+
+        # ANALYZE can't run in a transaction block.
+        with self.database.get_engine().connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute('ANALYZE')
+
+    def _get_plan_nodes(self, sql, data):
+        with self.database.get_engine().begin() as connection:
+            plan = connection.execute(sa.sql.text('EXPLAIN (FORMAT JSON) ' + sql), data).scalar()
+
+        found = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            found.append(node)
+            nodes.extend(node.get('Plans', []))
+        return found
+
+    def _get_seq_scans(self, sql, data):
+        return [node['Relation Name'] for node in self._get_plan_nodes(sql, data) if node['Node Type'] == 'Seq Scan'
+                and node['Relation Name'] in ('release', 'record', 'compiled_release')]
+
+    def _get_index_names(self, sql, data):
+        return {node['Index Name'] for node in self._get_plan_nodes(sql, data) if 'Index Name' in node}
+
+    def test_releases_to_check(self):
+        for obj_type in ('release', 'record'):
+            sql, data = self.database._get_check_query(obj_type, self.collection_ids[0], '', CHECK_LEVEL_FULL,
+                                                       after_id=1)
+            assert [] == self._get_seq_scans(sql, data)
+
+    def test_compile_releases_rows(self):
+        destination_collection_id = self.database.get_or_create_collection_id(
+            "test", datetime.datetime(2020, 1, 1), False, transform_from_collection_id=self.collection_ids[0],
+            transform_type=TRANSFORM_TYPE_COMPILE_RELEASES)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        sql, data = transform._get_rows_query(['ocds-213czf-1', 'ocds-213czf-2'])
+        assert [] == self._get_seq_scans(sql, data)
+        index_names = self._get_index_names(sql, data)
+        assert 'release_collection_id_ocid_idx' in index_names
+        assert 'record_collection_id_ocid_idx' in index_names
+
+    def test_compiled_release_replace(self):
+        bulk_store = CompiledReleaseBulkStore(self.database, self.collection_ids[0], replace=True)
+        statements, data = bulk_store._get_replace_queries(['test.json'])
+        for sql in statements:
+            assert [] == self._get_seq_scans(sql, data)
+
+    def test_pending_check_work(self):
+        self.database.mark_collection_check_data(self.collection_ids[0], True)
+        self.database.mark_collection_check_older_data_with_schema_version_1_1(self.collection_ids[0], True)
+        self.database.mark_collection_check_sample(self.collection_ids[0], sample_size=10)
+
+        sql, data = self.database._get_pending_work_query(PENDING_WORK_CHECK, checker_version='1')
+        assert [] == self._get_seq_scans(sql, data)
+
+    def test_upgrade_rows(self):
+        destination_collection_id = self.database.get_or_create_collection_id(
+            "test", datetime.datetime(2020, 1, 1), False, transform_from_collection_id=self.collection_ids[0],
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        for obj_type in ('release', 'record'):
+            for partitions in (1, 2):
+                sql, data = transform._get_rows_query(obj_type, 1, partitions=partitions)
+                assert [] == self._get_seq_scans(sql, data)
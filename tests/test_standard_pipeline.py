@@ -1,6 +1,11 @@
 import datetime
+import os
 
+import sqlalchemy as sa
+
+from ocdskingfisherprocess.store import Store
 from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES, TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
+from ocdskingfisherprocess.transform.upgrade_1_0_to_1_1 import Upgrade10To11Transform
 from tests.base import BaseDataBaseTest
 
 
@@ -37,3 +42,78 @@ class TestStandardPipelineOff(BaseDataBaseTest):
 
         collections = self.database.get_all_collections()
         assert 1 == len(collections)
+
+
+class TestStandardPipelineUpgradeOnWrite(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.run_standard_pipeline = True
+        self.config.standard_pipeline_upgrade_on_write = True
+
+    def test_release_package(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        upgrade_collection_id = store.get_upgrade_collection_id()
+        assert upgrade_collection_id
+
+        # The upgraded releases are stored with the source releases
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]) \
+                .where(self.database.release_table.c.collection_id == upgrade_collection_id)
+            releases = connection.execute(s).fetchall()
+            assert 2 == len(releases)
+            assert '1.1' == self.database.get_package_data(releases[0]['package_data_id'])['version']
+
+            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_release_table])
+            assert 2 == connection.execute(s).rowcount
+
+        # The transform has nothing left to do, other than to mark its collection as finished
+        self.database.mark_collection_store_done(collection_id)
+
+        upgrade_collection = self.database.get_collection(upgrade_collection_id)
+        transform = Upgrade10To11Transform(self.config, self.database, upgrade_collection)
+        transform.process()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]) \
+                .where(self.database.release_table.c.collection_id == upgrade_collection_id)
+            assert 2 == connection.execute(s).rowcount
+
+        upgrade_collection = self.database.get_collection(upgrade_collection_id)
+        assert upgrade_collection.store_end_at is not None
+
+    def test_deleted_upgrade_collection(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        upgrade_collection_id = store.get_upgrade_collection_id()
+        assert upgrade_collection_id
+
+        self.database.mark_collection_deleted_at(upgrade_collection_id)
+
+        # Data isn't upgraded into a deleted collection
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        assert store.get_upgrade_collection_id() is None
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]) \
+                .where(self.database.release_table.c.collection_id == upgrade_collection_id)
+            assert 0 == connection.execute(s).rowcount
@@ -1,10 +1,12 @@
 import datetime
+import json
 import os
 
+import ocdsmerge
 import sqlalchemy as sa
 
 from ocdskingfisherprocess.store import Store
-from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES
+from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES, compile_releases
 from ocdskingfisherprocess.transform.compile_releases import CompileReleasesTransform
 from tests.base import BaseDataBaseTest
 
@@ -167,6 +169,71 @@ class TestTransformCompileReleasesFromRecords(BaseDataBaseTest):
         destination_collection = self.database.get_collection(destination_collection_id)
         assert destination_collection.store_end_at is not None
 
+    def test_memo(self):
+
+        source_collection_id, source_collection, destination_collection_id, destination_collection = \
+            self._setup_collections_and_data_run_transform('sample_1_1_record_releases_not_compiled.json')
+
+        # Compile the same record again, into another collection
+        self._compile_into_another_collection(source_collection_id, source_collection)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_memo_table])
+            memos = connection.execute(s).fetchall()
+            assert 1 == len(memos)
+
+            s = sa.sql.select([self.database.compiled_release_table])
+            compiled_releases = connection.execute(s).fetchall()
+            assert 2 == len(compiled_releases)
+            assert {memos[0]['data_id']} == {row['data_id'] for row in compiled_releases}
+
+            # The record's releases were compiled
+            data = self.database.get_data(memos[0]['data_id'])
+            assert 'ocds-213czf-000-00001-2011-01-10T09:30:00Z' == data.get('id')
+
+    def _compile_into_another_collection(self, source_collection_id, source_collection):
+        other_destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            True,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_COMPILE_RELEASES)
+        transform = CompileReleasesTransform(self.config, self.database,
+                                             self.database.get_collection(other_destination_collection_id))
+        transform.process()
+
+    def _get_memo_count(self):
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_memo_table])
+            return len(connection.execute(s).fetchall())
+
+    def test_memo_other_schema(self, tmp_path):
+        source_collection_id, source_collection, destination_collection_id, destination_collection = \
+            self._setup_collections_and_data_run_transform('sample_1_1_record_releases_not_compiled.json')
+        assert 1 == self._get_memo_count()
+
+        # A local schema with other merge rules.
+        schema = tmp_path / 'release-schema.json'
+        schema.write_text(json.dumps({'properties': {'tag': {'type': 'array', 'omitWhenMerged': True}}}))
+        self.config.compile_releases_schema = str(schema)
+        self._compile_into_another_collection(source_collection_id, source_collection)
+        assert 2 == self._get_memo_count()
+
+    def test_memo_other_merge_rules(self, monkeypatch):
+        source_collection_id, source_collection, destination_collection_id, destination_collection = \
+            self._setup_collections_and_data_run_transform('sample_1_1_record_releases_not_compiled.json')
+        assert 1 == self._get_memo_count()
+
+        # The same schema, with merge rules that have changed since the memo was stored.
+        merger = compile_releases._get_merger(self.config.compile_releases_schema)
+        monkeypatch.setattr(compile_releases, '_mergers', {
+            self.config.compile_releases_schema: ocdsmerge.Merger(merge_rules=merger.merge_rules,
+                                                                  rule_overrides={('awards',): ocdsmerge.APPEND}),
+        })
+        monkeypatch.setattr(compile_releases, '_merge_settings', {})
+        self._compile_into_another_collection(source_collection_id, source_collection)
+        assert 2 == self._get_memo_count()
+
     def test_two_records_same_ocid(self):
         source_collection_id, source_collection, destination_collection_id, destination_collection = \
             self._setup_collections_and_data_run_transform(
@@ -3,6 +3,7 @@ import os
 
 import sqlalchemy as sa
 
+from ocdskingfisherprocess.database import CollectionNoteBulkStore, CompiledReleaseBulkStore
 from ocdskingfisherprocess.store import Store
 from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES
 from ocdskingfisherprocess.transform.compile_releases import CompileReleasesTransform
@@ -154,3 +155,243 @@ class TestTransformCompileReleasesFromReleases(BaseDataBaseTest):
         # Check collection notes
         notes = self.database.get_all_notes_in_collection(destination_collection_id)
         assert len(notes) == 0
+
+    def test_memo(self):
+
+        source_collection_id, source_collection, destination_collection_id, destination_collection = \
+            self._setup_collections_and_data_run_transform('sample_1_1_releases_multiple_with_same_ocid.json')
+
+        # Compile the same data again, into another collection
+        other_destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            True,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_COMPILE_RELEASES)
+        transform = CompileReleasesTransform(self.config, self.database,
+                                             self.database.get_collection(other_destination_collection_id))
+        transform.process()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_memo_table])
+            memos = connection.execute(s).fetchall()
+            assert 1 == len(memos)
+
+            s = sa.sql.select([self.database.compiled_release_table])
+            compiled_releases = connection.execute(s).fetchall()
+            assert 2 == len(compiled_releases)
+            assert {memos[0]['data_id']} == {row['data_id'] for row in compiled_releases}
+
+        # The memo is deleted with the compiled releases that use it
+        self.database.mark_collection_deleted_at(destination_collection_id)
+        self.database.mark_collection_deleted_at(other_destination_collection_id)
+        self.database.delete_collection(destination_collection_id)
+        self.database.delete_collection(other_destination_collection_id)
+        self.database.delete_orphan_data()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_memo_table])
+            assert 0 == connection.execute(s).rowcount
+
+
+class TestTransformCompileReleasesFromReleasesInWorkers(TestTransformCompileReleasesFromReleases):
+
+    def alter_config(self):
+        self.config.compile_releases_workers = 2
+
+
+class TestTransformCompileReleasesFromReleasesWithLocalSchema(TestTransformCompileReleasesFromReleases):
+
+    def alter_config(self):
+        self.config.compile_releases_schema = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'release-schema.json'
+        )
+
+
+class TestCompiledReleaseBulkStore(BaseDataBaseTest):
+
+    def test_duplicates_are_skipped(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+
+        with CompiledReleaseBulkStore(self.database, collection_id, batch_size=2) as bulk_store:
+            bulk_store.add('ocds-1', {'ocid': 'ocds-1', 'date': '2011-01-10'}, warnings=['A warning'])
+            bulk_store.add('ocds-2', {'ocid': 'ocds-2', 'date': '2011-01-10'})
+            # In a later batch
+            bulk_store.add('ocds-1', {'ocid': 'ocds-1', 'date': '2012-01-10'})
+            # In the same batch
+            bulk_store.add('ocds-3', {'ocid': 'ocds-3', 'date': '2011-01-10'})
+            bulk_store.add('ocds-3', {'ocid': 'ocds-3', 'date': '2012-01-10'})
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_table]) \
+                .order_by(self.database.compiled_release_table.c.ocid)
+            compiled_releases = connection.execute(s).fetchall()
+            assert ['ocds-1', 'ocds-2', 'ocds-3'] == [row['ocid'] for row in compiled_releases]
+            assert '2011-01-10' == self.database.get_data(compiled_releases[0]['data_id'])['date']
+            assert '2011-01-10' == self.database.get_data(compiled_releases[2]['data_id'])['date']
+
+            # The data of skipped compiled releases isn't stored
+            s = sa.sql.select([self.database.data_table])
+            assert 3 == connection.execute(s).rowcount
+
+            collection_file_item_id = compiled_releases[0]['collection_file_item_id']
+            s = sa.sql.select([self.database.collection_file_item_table]) \
+                .where(self.database.collection_file_item_table.c.id == collection_file_item_id)
+            assert ['A warning'] == connection.execute(s).fetchone()['warnings']
+
+
+class TestCollectionNoteBulkStore(BaseDataBaseTest):
+
+    def test_duplicates_are_skipped(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        self.database.add_collection_note(collection_id, 'A note')
+
+        with CollectionNoteBulkStore(self.database, collection_id, batch_size=2) as note_store:
+            note_store.add('Another note')
+            # Already stored
+            note_store.add('A note')
+            # In the same batch
+            note_store.add('A third note')
+            note_store.add('A third note')
+
+        self.database.add_collection_note(collection_id, 'Another note')
+
+        notes = self.database.get_all_notes_in_collection(collection_id)
+        assert ['A note', 'Another note', 'A third note'] == [note.note for note in notes]
+
+
+class TestTransformCompileReleasesWhileStoring(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.compile_releases_while_storing = True
+
+    def _get_compiled_releases(self):
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.compiled_release_table])
+            return connection.execute(s).fetchall()
+
+    def test_compile_while_storing(self):
+
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_COMPILE_RELEASES)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # Load some data
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # transform! This should compile the data so far, even though the source is not finished
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        compiled_releases = self._get_compiled_releases()
+        assert 1 == len(compiled_releases)
+        assert self.database.get_collection(destination_collection_id).store_end_at is None
+
+        # Load more data for the same ocid
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases_some_dates.json'
+        )
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # transform! The compiled release should be replaced
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        new_compiled_releases = self._get_compiled_releases()
+        assert 1 == len(new_compiled_releases)
+        assert compiled_releases[0]['id'] != new_compiled_releases[0]['id']
+        assert self.database.get_collection(destination_collection_id).store_end_at is None
+
+        # transform again! Nothing new, so nothing should change
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        assert new_compiled_releases == self._get_compiled_releases()
+
+        # Mark source collection as finished
+        self.database.mark_collection_store_done(source_collection_id)
+
+        # transform! This should compile everything once more, and finish
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        final_compiled_releases = self._get_compiled_releases()
+        assert 1 == len(final_compiled_releases)
+        assert new_compiled_releases[0]['data_id'] == final_compiled_releases[0]['data_id']
+        assert self.database.get_collection(destination_collection_id).store_end_at is not None
+
+    def test_compile_rows_committed_out_of_order(self):
+
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_COMPILE_RELEASES)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # Load some data, and transform it
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        compiled_releases = self._get_compiled_releases()
+        assert 1 == len(compiled_releases)
+
+        # Load more data for the same ocid, but make it look as if it had been committed before the last window
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases_some_dates.json'
+        )
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        with self.database.get_engine().begin() as connection:
+            connection.execute(sa.sql.text("""
+                UPDATE transform_compile_releases_watermark
+                SET release_id = (SELECT max(id) FROM release WHERE collection_id = :source_collection_id)
+                WHERE collection_id = :collection_id
+            """), {'collection_id': destination_collection_id, 'source_collection_id': source_collection_id})
+
+        # transform! The window missed the data, so nothing changes
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        assert compiled_releases == self._get_compiled_releases()
+
+        # Mark source collection as finished
+        self.database.mark_collection_store_done(source_collection_id)
+
+        # transform! The data is compiled this time
+        transform = CompileReleasesTransform(self.config, self.database, destination_collection)
+        transform.process()
+
+        new_compiled_releases = self._get_compiled_releases()
+        assert 1 == len(new_compiled_releases)
+        assert compiled_releases[0]['data_id'] != new_compiled_releases[0]['data_id']
+        assert self.database.get_collection(destination_collection_id).store_end_at is not None
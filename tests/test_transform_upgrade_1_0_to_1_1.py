@@ -4,7 +4,7 @@ import os
 import sqlalchemy as sa
 
 from ocdskingfisherprocess.store import Store
-from ocdskingfisherprocess.transform import TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
+from ocdskingfisherprocess.transform import TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1, upgrade_1_0_to_1_1
 from ocdskingfisherprocess.transform.upgrade_1_0_to_1_1 import Upgrade10To11Transform
 from tests.base import BaseDataBaseTest
 
@@ -172,3 +172,206 @@ class TestTransformUpgrade10To11(BaseDataBaseTest):
         # destination collection should be closed
         destination_collection = self.database.get_collection(destination_collection_id)
         assert destination_collection.store_end_at is not None
+
+    def test_release_batches(self, monkeypatch):
+        monkeypatch.setattr(upgrade_1_0_to_1_1, 'UPGRADE_BATCH_SIZE', 1)
+
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Load some data
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # transform!
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        # check: each batch is stored in the same collection file item as in the source
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]) \
+                .where(self.database.release_table.c.collection_id == destination_collection_id)
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+            assert 1 == len({row['collection_file_item_id'] for row in result})
+
+            s = sa.sql.select([self.database.collection_file_table]) \
+                .where(self.database.collection_file_table.c.collection_id == destination_collection_id)
+            result = connection.execute(s)
+            assert ['test.json'] == [row['filename'] for row in result]
+
+            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_release_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+    def test_release_1_1(self):
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Load some data that is already 1.1
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # transform!
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        # check: the destination releases use the same data as the source releases
+        with self.database.get_engine().begin() as connection:
+            def get_releases(collection_id):
+                s = sa.sql.select([self.database.release_table]) \
+                    .where(self.database.release_table.c.collection_id == collection_id) \
+                    .order_by(self.database.release_table.c.release_id)
+                return [(row['release_id'], row['ocid'], row['data_id'], row['package_data_id'])
+                        for row in connection.execute(s)]
+
+            assert 6 == len(get_releases(destination_collection_id))
+            assert get_releases(source_collection_id) == get_releases(destination_collection_id)
+
+    def test_watermark(self):
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Load some data
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # transform!
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        file_item = self.database.get_all_files_items_in_file(
+            self.database.get_all_files_in_collection(source_collection_id)[0]
+        )[0]
+        assert file_item.database_id == self.database.get_upgrade_1_0_to_1_1_watermark(destination_collection_id)
+
+        # Forget that the releases were upgraded, as if they had been committed out of order
+        with self.database.get_engine().begin() as connection:
+            connection.execute(self.database.transform_upgrade_1_0_to_1_1_status_release_table.delete())
+
+        # Load some more data
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # transform again! Only the new item is looked at
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_release_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+        # Mark source collection as finished
+        self.database.mark_collection_store_done(source_collection_id)
+
+        # transform again! Every item is looked at
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.transform_upgrade_1_0_to_1_1_status_release_table])
+            result = connection.execute(s)
+            assert 4 == result.rowcount
+
+        destination_collection = self.database.get_collection(destination_collection_id)
+        assert destination_collection.store_end_at is not None
+
+
+class TestTransformUpgrade10To11InWorkers(TestTransformUpgrade10To11):
+
+    def alter_config(self):
+        self.config.upgrade_1_0_to_1_1_workers = 2
+
+
+class TestTransformUpgrade10To11Memo(BaseDataBaseTest):
+
+    def test_release_memo(self, monkeypatch):
+        monkeypatch.setattr(upgrade_1_0_to_1_1, 'UPGRADE_BATCH_SIZE', 1)
+        calls = []
+        original = upgrade_1_0_to_1_1.upgrade_10_11
+
+        def upgrade_10_11(data):
+            calls.append(data)
+            return original(data)
+
+        monkeypatch.setattr(upgrade_1_0_to_1_1, 'upgrade_10_11', upgrade_10_11)
+
+        # Make source collection
+        source_collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        source_collection = self.database.get_collection(source_collection_id)
+
+        # Load the same data twice
+        store = Store(self.config, self.database)
+        store.set_collection(source_collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # Make destination collection
+        destination_collection_id = self.database.get_or_create_collection_id(
+            source_collection.source_id,
+            source_collection.data_version,
+            source_collection.sample,
+            transform_from_collection_id=source_collection_id,
+            transform_type=TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1)
+        destination_collection = self.database.get_collection(destination_collection_id)
+
+        # transform!
+        transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
+        transform.process()
+
+        # check: each release is upgraded once, and the package data is shared
+        assert 2 == len(calls)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table]) \
+                .where(self.database.release_table.c.collection_id == destination_collection_id)
+            result = connection.execute(s).fetchall()
+            assert 4 == len(result)
+            assert 2 == len({row['data_id'] for row in result})
+            assert 1 == len({row['package_data_id'] for row in result})
+            assert '1.1' == self.database.get_package_data(result[0]['package_data_id'])['version']